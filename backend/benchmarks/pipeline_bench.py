@@ -0,0 +1,219 @@
+"""
+CPU micro-benchmarks of the request pipeline's glue code.
+
+The models are replaced by stand-ins built with __new__, so no weights are loaded
+and nothing runs on the GPU; only the image/mask processing around them is timed.
+
+Run from backend/:
+    python -m benchmarks.pipeline_bench --output bench.json
+    python -m benchmarks.pipeline_bench --baseline bench.json --tolerance 0.2
+
+With --baseline the run exits with status 1 if any case got slower than the
+baseline by more than the tolerance.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from model.diffusion_pipline import AdvancedInpaintingPipeline, make_canny_condition, prepare_mask, \
+    match_color_distribution
+from model.sam2 import SAM2, SAM2State
+from routes.encoding import EncodingOptions, encode_image
+
+# (width, height) of typical uploads: web image, phone photo, high-end camera
+IMAGE_SIZES = {
+    "1mp": (1152, 864),
+    "12mp": (4000, 3000),
+    "24mp": (6000, 4000)
+}
+MASK_COUNTS = (1, 4)
+MODEL_SIZE = 1024
+
+
+def make_image(size: tuple) -> Image.Image:
+    """Deterministic photo-like RGB image: smooth gradients, shapes and mild noise."""
+    width, height = size
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = (x * 0.6 + y * 0.4).astype(np.uint8)
+    image[..., 1] = (255 - y * 0.7).astype(np.uint8)
+    image[..., 2] = (x * 0.3 + 60).astype(np.uint8)
+    rng = np.random.default_rng(0)
+    for _ in range(12):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        radius = int(rng.integers(min(size) // 20, min(size) // 5))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(image, center, radius, color, thickness=-1)
+    image = cv2.add(image, rng.integers(0, 8, image.shape, dtype=np.uint8))
+    return Image.fromarray(image)
+
+
+def make_masks(size: tuple, count: int) -> np.ndarray:
+    """(N, 1, H, W) float32 masks like SAM2 returns, one ellipse per object."""
+    width, height = size
+    masks = np.zeros((count, 1, height, width), dtype=np.float32)
+    for i in range(count):
+        center = (width * (i + 1) // (count + 1), height // 2)
+        axes = (width // (3 * count), height // 4)
+        cv2.ellipse(masks[i, 0], center, axes, 0, 0, 360, 1.0, thickness=-1)
+    return masks
+
+
+def stand_in_pipeline() -> AdvancedInpaintingPipeline:
+    """Inpainting pipeline without ControlNet, SDXL or CLIP loaded."""
+    return AdvancedInpaintingPipeline.__new__(AdvancedInpaintingPipeline)
+
+
+def stand_in_sam2() -> SAM2:
+    """SAM2 without the predictor; the overlay only needs the session state."""
+    return SAM2.__new__(SAM2)
+
+
+def time_case(fn, repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": statistics.median(timings),
+        "min_ms": min(timings),
+        "mean_ms": statistics.fmean(timings),
+        "repeat": repeat
+    }
+
+
+def build_cases(size_name: str, size: tuple, mask_counts) -> dict:
+    """Benchmark callables for one image size, with their inputs prepared up front."""
+    pipeline = stand_in_pipeline()
+    sam2 = stand_in_sam2()
+    image = make_image(size)
+    masks = make_masks(size, 1)
+    mask_array = masks[0]
+    prepared, _ = prepare_mask(mask_array)
+    result = pipeline.preprocess_image(image, MODEL_SIZE).resize(size)
+    _, feather = prepare_mask(mask_array, feather_radius=10)
+    png = EncodingOptions('png')
+
+    cases = {
+        "prepare_mask": lambda: prepare_mask(mask_array, 1.1),
+        "prepare_mask[feathered]": lambda: prepare_mask(mask_array, 1.1, feather_radius=10),
+        "preprocess_image": lambda: pipeline.preprocess_image(image, MODEL_SIZE),
+        "preprocess_mask": lambda: pipeline.preprocess_mask(prepared, MODEL_SIZE),
+        "match_color_distribution": lambda: match_color_distribution(result, image, prepared),
+        "match_color_distribution[feathered]": lambda: match_color_distribution(
+            result, image, feather),
+        "make_canny_condition": lambda: make_canny_condition(image),
+        "encode_png": lambda: encode_image(result, png)
+    }
+    for count in mask_counts:
+        state = SAM2State()
+        state.image = image
+        state.masks = make_masks(size, count)
+        cases[f"apply_bluer_mask[{count}masks]"] = \
+            lambda state=state: sam2.apply_bluer_mask(state)
+    return {f"{name}@{size_name}": fn for name, fn in cases.items()}
+
+
+def run(sizes: list[str], mask_counts, repeat: int, name_filter: str | None = None) -> dict:
+    results = {}
+    for size_name in sizes:
+        for name, fn in build_cases(size_name, IMAGE_SIZES[size_name], mask_counts).items():
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = time_case(fn, repeat)
+            print(f"{name:45s} {results[name]['median_ms']:10.2f} ms", file=sys.stderr)
+    return {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "opencv": cv2.__version__,
+            "threads": torch.get_num_threads()
+        },
+        "results": results
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.2) -> list[dict]:
+    """
+    Compare median timings of the cases present in both runs.
+
+    Returns:
+    - list[dict]: One row per case with the baseline and current medians, their
+        ratio and whether it is a regression (ratio > 1 + tolerance).
+    """
+    rows = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["median_ms"]
+        after = result["median_ms"]
+        ratio = after / before if before > 0 else float("inf")
+        rows.append({
+            "case": name,
+            "baseline_ms": before,
+            "current_ms": after,
+            "ratio": ratio,
+            "regression": ratio > 1 + tolerance
+        })
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(IMAGE_SIZES),
+                        help="Comma-separated image sizes: " + ", ".join(IMAGE_SIZES))
+    parser.add_argument("--masks", default=",".join(map(str, MASK_COUNTS)),
+                        help="Comma-separated mask counts for the overlay cases")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default=None,
+                        help="Only run cases whose name contains this string")
+    parser.add_argument("--output", default=None, help="Write the results JSON here")
+    parser.add_argument("--baseline", default=None,
+                        help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown before a case counts as a regression")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(",")
+    unknown = [size for size in sizes if size not in IMAGE_SIZES]
+    if unknown:
+        parser.error(f"Unknown sizes: {', '.join(unknown)}")
+    mask_counts = [int(count) for count in args.masks.split(",")]
+
+    current = run(sizes, mask_counts, args.repeat, args.filter)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(current, baseline, args.tolerance)
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['case']:45s} {row['baseline_ms']:10.2f} -> {row['current_ms']:10.2f} ms "
+              f"({row['ratio']:.2f}x) {flag}")
+    regressions = [row for row in rows if row["regression"]]
+    if regressions:
+        print(f"{len(regressions)} of {len(rows)} cases regressed by more than "
+              f"{args.tolerance:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
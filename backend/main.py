@@ -1,8 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from routes.sam2_route import router as sam2_route
 from routes.groundingDINO_route import router as groundingdino_route
 from routes.diffusion_route import router as diffusion_route
+from routes.image_route import router as image_route
+from routes.text2mask_route import router as text2mask_route
+from model.registry import registry
+from model.session import session_manager
+from model.placement import placement_manager
+from model import metrics
 
 app = FastAPI(
     title="Chatbot API",
@@ -26,8 +33,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+
 
 # include the route
+app.include_router(image_route, prefix="/images")
 app.include_router(sam2_route, prefix="/sam2")
 app.include_router(groundingdino_route, prefix="/groundingdino")
 app.include_router(diffusion_route, prefix="/diffusion")
+app.include_router(text2mask_route, prefix="/text2mask")
+
+
+@app.get("/models")
+def models():
+    """Load state, load time and memory of every registered model."""
+    return registry.status()
+
+
+@app.post("/warmup")
+def warmup(models: list[str] | None = None):
+    """Load the given models (default: all) so the first request does not pay for it."""
+    try:
+        return registry.warmup(models)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/placement")
+def placement():
+    """Device budget, where each model lives and the placement manager's recent decisions."""
+    return placement_manager.status()
+
+
+@app.get("/sessions")
+def sessions():
+    """Live sessions, their memory use and eviction counts."""
+    return session_manager.stats()
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    if not session_manager.remove(session_id):
+        raise HTTPException(status_code=404, detail=f"Unknown session: {session_id}")
+    return {"session_id": session_id, "deleted": True}
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus scrape endpoint: route and stage latencies, queues, caches, models and memory."""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
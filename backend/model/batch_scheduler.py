@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    Groups compatible work items into batches within a latency window.
+
+    Items with the same batch_key(item) can share a batch. A group is dispatched as
+    soon as it holds max_batch_size items, or once its oldest item has waited
+    max_wait_seconds. A single dispatcher thread calls run_batch(items), which must
+    return one result per item in order; items that arrive meanwhile keep grouping.
+    """
+
+    def __init__(self, run_batch, batch_key, max_batch_size: int = 4,
+                 max_wait_seconds: float = 0.25, name: str = "batches"):
+        self.run_batch = run_batch
+        self.batch_key = batch_key
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.name = name
+        # batch key -> list of (item, future, enqueued_at), oldest group first
+        self.groups = OrderedDict()
+        self.condition = threading.Condition()
+        self.worker = None
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self._run, name=f"{self.name}-dispatcher", daemon=True)
+                self.worker.start()
+
+    def submit(self, item) -> Future:
+        """Schedule an item; the future resolves to its result from run_batch."""
+        self.start()
+        future = Future()
+        with self.condition:
+            self.groups.setdefault(self.batch_key(item), []).append(
+                (item, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def stats(self) -> dict:
+        with self.condition:
+            waiting = sum(len(group) for group in self.groups.values())
+            groups = len(self.groups)
+        return {
+            "name": self.name,
+            "waiting": waiting,
+            "groups": groups,
+            "batches": self.batches,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_seconds": self.max_wait_seconds
+        }
+
+    def _next_batch(self):
+        # Caller holds self.condition. Returns a ready batch or the seconds until one is due.
+        now = time.monotonic()
+        next_due = None
+        for key, group in self.groups.items():
+            due = group[0][2] + self.max_wait_seconds
+            if len(group) >= self.max_batch_size or due <= now:
+                batch = group[:self.max_batch_size]
+                del group[:self.max_batch_size]
+                if not group:
+                    del self.groups[key]
+                return batch, None
+            next_due = due if next_due is None else min(next_due, due)
+        return None, None if next_due is None else next_due - now
+
+    def _run(self):
+        while True:
+            with self.condition:
+                batch, timeout = self._next_batch()
+                while batch is None:
+                    self.condition.wait(timeout)
+                    batch, timeout = self._next_batch()
+                self.batches += 1
+                self.items += len(batch)
+
+            items = [item for item, _, _ in batch]
+            try:
+                results = list(self.run_batch(items))
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"{self.name}: run_batch returned {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,115 @@
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+import torch
+from PIL import Image
+
+
+def estimate_nbytes(value) -> int:
+    """Estimate the memory held by a cached value (tensors, arrays, images and containers of them)."""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in value)
+    return 0
+
+
+# Every live cache, so metrics can report them without explicit registration
+_caches = weakref.WeakSet()
+
+
+def all_caches() -> list["LRUCache"]:
+    return list(_caches)
+
+
+def track_cache(cache):
+    """Report another kind of cache (anything with a compatible stats()) in metrics."""
+    _caches.add(cache)
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by an estimated byte budget."""
+
+    def __init__(self, max_bytes: int, name: str = "cache"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        track_cache(self)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, nbytes: int | None = None):
+        """
+        Insert a value, evicting least-recently-used entries to stay within budget.
+
+        Values larger than the whole budget are not cached.
+        """
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, nbytes = self.entries.pop(key)
+            self.current_bytes -= nbytes
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
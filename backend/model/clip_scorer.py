@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import CLIPProcessor, CLIPModel
+from model.cache import LRUCache
+
+PLACEMENTS = {'resident', 'offload', 'managed'}
+
+
+class ClipScorer:
+    """
+    Scores images against a prompt with CLIP cosine similarity.
+
+    Placement policy:
+    - 'resident': the model stays on `device` between calls.
+    - 'offload': the model lives on the CPU and visits `device` once per score call,
+        not once per image.
+    - 'managed': a PlacementManager decides, registered as "clip"; used automatically
+        when placement_manager is given.
+
+    Text embeddings are cached per prompt, in `text_cache` when one is shared (e.g.
+    with the inpainting pipeline's prompt embeddings); images are embedded in batches.
+    Pass device="cpu" to run the scoring logic without a GPU.
+    """
+
+    def __init__(self, model_name: str = "openai/clip-vit-large-patch14",
+                 device: str = "cuda", placement: str = "resident",
+                 batch_size: int = 8, text_cache_bytes: int = 16 * 1024 ** 2,
+                 model: CLIPModel | None = None, processor: CLIPProcessor | None = None,
+                 text_cache: LRUCache | None = None, placement_manager=None):
+        if placement_manager is not None:
+            placement = 'managed'
+        if placement not in PLACEMENTS:
+            raise ValueError(f"Unknown placement: {placement}")
+        if placement == 'managed' and placement_manager is None:
+            raise ValueError("The 'managed' placement needs a placement_manager")
+        self.model_name = model_name
+        self.device = device
+        self.placement = placement
+        self.placement_manager = placement_manager
+        self.batch_size = batch_size
+        self.dtype = torch.float16 if str(device).startswith("cuda") else torch.float32
+
+        self.model = model if model is not None else CLIPModel.from_pretrained(
+            model_name, torch_dtype=self.dtype)
+        self.model.eval()
+        self.processor = processor if processor is not None else CLIPProcessor.from_pretrained(
+            model_name)
+        self.model.to(self.device if placement == 'resident' else "cpu")
+        if placement == 'managed':
+            placement_manager.register("clip", self.model, priority=1)
+
+        self.text_cache = text_cache if text_cache is not None else LRUCache(
+            text_cache_bytes, name="clip_text")
+
+    @contextmanager
+    def on_device(self):
+        """Make sure the model is on the scoring device for the duration of the block."""
+        if self.placement == 'managed':
+            with self.placement_manager.use("clip"):
+                yield
+            return
+        if self.placement == 'offload':
+            self.model.to(self.device)
+        try:
+            yield
+        finally:
+            if self.placement == 'offload':
+                self.model.to("cpu")
+
+    @torch.no_grad()
+    def text_embedding(self, prompt: str) -> torch.Tensor:
+        """Return the L2-normalized text embedding of a prompt, shape (1, D)."""
+        key = ("clip", self.model_name, prompt)
+        embedding = self.text_cache.get(key)
+        if embedding is None:
+            inputs = self.processor(
+                text=[prompt], return_tensors="pt", padding=True, truncation=True
+            ).to(self.device)
+            embedding = F.normalize(
+                self.model.get_text_features(**inputs).float(), dim=-1)
+            self.text_cache.put(key, embedding)
+        return embedding
+
+    @torch.no_grad()
+    def image_embeddings(self, images: list[Image.Image]) -> torch.Tensor:
+        """Return L2-normalized image embeddings, shape (N, D), computed in batches."""
+        embeddings = []
+        for start in range(0, len(images), self.batch_size):
+            inputs = self.processor(
+                images=images[start:start + self.batch_size], return_tensors="pt")
+            pixel_values = inputs["pixel_values"].to(self.device, self.dtype)
+            features = self.model.get_image_features(pixel_values=pixel_values)
+            embeddings.append(F.normalize(features.float(), dim=-1))
+        return torch.cat(embeddings)
+
+    def score(self, images: list[Image.Image], prompt: str) -> list[float]:
+        """Cosine similarity between each image and the prompt."""
+        if not images:
+            return []
+        with self.on_device():
+            text = self.text_embedding(prompt)
+            image = self.image_embeddings(images)
+        return (image @ text.T)[:, 0].cpu().tolist()
@@ -1,23 +1,61 @@
 from groundingdino.util.inference import load_model, load_image, predict, annotate
 import groundingdino.datasets.transforms as T
-from PIL import Image
-from io import BytesIO
+from model.image_store import image_store
+from model.registry import registry
+from model.metrics import timed
+from model.cache import LRUCache, estimate_nbytes
+from model.placement import placement_manager
 import numpy as np
+import threading
 import torch
 
 BOX_TRESHOLD = 0.35
 TEXT_TRESHOLD = 0.25
 
 
-class GroundingDINO:
+def nested_tensor_nbytes(features, poss) -> int:
+    """Memory held by the backbone's NestedTensor features and position encodings."""
+    return sum(estimate_nbytes(f.tensors) + estimate_nbytes(f.mask) for f in features) \
+        + estimate_nbytes(poss)
+
+
+class GroundingDINOState:
+    """Per-session GroundingDINO state: the current transformed image and latest detections."""
+
     def __init__(self):
-        self.model = load_model("weights/groundingdino/GroundingDINO_SwinT_OGC.py",
-                                "weights/groundingdino/groundingdino_swint_ogc.pth").to("cuda")
+        self.image_id = None
+        self.image_transformed = None
         self.boxes = None
         self.logits = None
         self.phrases = None
 
-    def set_image(self, image_bytes: bytes):
+    def nbytes(self) -> int:
+        """Bytes of the detections; the transformed image is rebuilt from the shared store."""
+        return estimate_nbytes([self.boxes, self.logits])
+
+
+class GroundingDINO:
+    """Shared GroundingDINO model. Per-client data lives in GroundingDINOState objects."""
+
+    def __init__(self, feature_cache_bytes: int = 512 * 1024 ** 2):
+        self.device = placement_manager.device
+        # Loaded on the host; the placement manager moves it to the device when it runs
+        self.model = load_model("weights/groundingdino/GroundingDINO_SwinT_OGC.py",
+                                "weights/groundingdino/groundingdino_swint_ogc.pth", device="cpu")
+        placement_manager.register("groundingdino", self.model, priority=2)
+        # The model holds image features as attributes during a forward pass
+        self.lock = threading.Lock()
+        # Swin backbone outputs per image hash; new captions only run text and fusion
+        self.feature_cache = LRUCache(
+            feature_cache_bytes, name="groundingdino_features")
+        # Raw detections per (image, prompt, box threshold, text threshold)
+        self.result_cache = LRUCache(
+            16 * 1024 ** 2, name="groundingdino_results")
+
+    def set_image(self, state: GroundingDINOState, image_id: str):
+        if image_id == state.image_id:
+            return
+        image_source = image_store.get(image_id)
         transform = T.Compose(
             [
                 T.RandomResize([800], max_size=1333),
@@ -25,37 +63,105 @@ class GroundingDINO:
                 T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
             ]
         )
-        image_source = Image.open(BytesIO(image_bytes)).convert("RGB")
         image_transformed, _ = transform(image_source, None)
-        self.image_transformed = image_transformed.to("cuda")
-
-    def predict(self, prompt: str, single_target_mode: bool):
-        with torch.no_grad():
-            boxes, logits, phrases = predict(
-                model=self.model,
-                image=self.image_transformed,
-                caption=prompt,
-                box_threshold=BOX_TRESHOLD,
-                text_threshold=TEXT_TRESHOLD
-            )
-            if single_target_mode:
-                max_idx = logits.argmax()
-                self.boxes = boxes[max_idx].unsqueeze(0).cpu()
-                self.logits = logits[max_idx].unsqueeze(0).cpu()
-                self.phrases = [phrases[max_idx]]
-            else:
-                self.boxes = boxes.cpu()
-                self.logits = logits.cpu()
-                self.phrases = phrases
-
-    def get_boxes(self):
-        return self.boxes.tolist()
-
-    def get_logits(self):
-        return self.logits.tolist()
-
-    def get_phrases(self):
-        return self.phrases
-
-
-groundingdino_model = GroundingDINO()
+        state.image_transformed = image_transformed.to(self.device)
+        state.image_id = image_id
+        state.boxes = state.logits = state.phrases = None
+
+    def image_features(self, state: GroundingDINOState):
+        """Backbone features of the session's image, computed once per image hash. Caller holds self.lock."""
+        cached = self.feature_cache.get(state.image_id)
+        if cached is None:
+            with torch.no_grad(), placement_manager.use("groundingdino"), \
+                    timed("groundingdino_backbone"):
+                self.model.set_image_tensor(state.image_transformed[None])
+            cached = (list(self.model.features), list(self.model.poss))
+            self.model.unset_image_tensor()
+            self.feature_cache.put(
+                state.image_id, cached, nbytes=nested_tensor_nbytes(*cached))
+        return cached
+
+    def detect(self, state: GroundingDINOState, prompt: str, box_threshold: float = BOX_TRESHOLD,
+               text_threshold: float = TEXT_TRESHOLD):
+        """
+        Detect a caption in the session's image, reusing cached backbone features.
+
+        Returns:
+        - tuple: (boxes, logits, phrases) on the CPU, boxes as normalized cxcywh.
+        """
+        if state.image_transformed is None:
+            raise ValueError("No image set")
+        key = (state.image_id, prompt, box_threshold, text_threshold)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+
+        with self.lock:
+            features, poss = self.image_features(state)
+            try:
+                # The model skips its backbone when features are already set. Its forward
+                # appends the extra feature level's position encoding to poss, so hand it
+                # copies to keep the cached lists unchanged.
+                self.model.set_image_features(list(features), list(poss))
+                with torch.no_grad(), placement_manager.use("groundingdino"), \
+                        timed("groundingdino_detect"):
+                    boxes, logits, phrases = predict(
+                        model=self.model,
+                        image=state.image_transformed,
+                        caption=prompt,
+                        box_threshold=box_threshold,
+                        text_threshold=text_threshold,
+                        device=self.device
+                    )
+            finally:
+                self.model.unset_image_tensor()
+
+        result = (boxes.cpu(), logits.cpu(), phrases)
+        self.result_cache.put(key, result)
+        return result
+
+    @staticmethod
+    def select(boxes, logits, phrases, single_target_mode: bool):
+        """Keep only the most confident detection in single target mode."""
+        if single_target_mode and len(logits) > 0:
+            max_idx = logits.argmax()
+            return boxes[max_idx].unsqueeze(0), logits[max_idx].unsqueeze(0), [phrases[max_idx]]
+        return boxes, logits, phrases
+
+    def predict(self, state: GroundingDINOState, prompt: str, single_target_mode: bool,
+                box_threshold: float = BOX_TRESHOLD, text_threshold: float = TEXT_TRESHOLD):
+        state.boxes, state.logits, state.phrases = self.select(
+            *self.detect(state, prompt, box_threshold, text_threshold), single_target_mode)
+
+    def predict_batch(self, state: GroundingDINOState, prompts: list[str], single_target_mode: bool,
+                      box_threshold: float = BOX_TRESHOLD, text_threshold: float = TEXT_TRESHOLD):
+        """
+        Detect several prompts against the session's image with one backbone pass.
+
+        Returns:
+        - list[dict]: {"prompt", "boxes", "logits", "phrases"} per prompt.
+        """
+        results = []
+        for prompt in prompts:
+            boxes, logits, phrases = self.select(
+                *self.detect(state, prompt, box_threshold, text_threshold), single_target_mode)
+            results.append({"prompt": prompt, "boxes": boxes.tolist(),
+                           "logits": logits.tolist(), "phrases": phrases})
+        return results
+
+    def get_boxes(self, state: GroundingDINOState):
+        return state.boxes.tolist()
+
+    def get_logits(self, state: GroundingDINOState):
+        return state.logits.tolist()
+
+    def get_phrases(self, state: GroundingDINOState):
+        return state.phrases
+
+
+# Loaded on first use or through /warmup
+registry.register("groundingdino", GroundingDINO)
+
+
+def get_groundingdino_model() -> GroundingDINO:
+    return registry.get("groundingdino")
@@ -0,0 +1,59 @@
+import hashlib
+from io import BytesIO
+from PIL import Image
+from model.cache import LRUCache, estimate_nbytes
+
+
+class ImageStore:
+    """Content-addressed store of decoded images shared by SAM2, GroundingDINO and diffusion.
+
+    Images are keyed by the SHA-256 of the uploaded bytes, so uploading the same
+    file twice decodes it only once and returns the same image id. Least recently
+    used images are dropped once the decoded pixels exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 1024 ** 3):
+        # Bounded by decoded size: a 24 MP upload holds ~72 MB of RGB pixels
+        self.cache = LRUCache(max_bytes, name="images")
+
+    @staticmethod
+    def hash_bytes(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def put(self, image_bytes: bytes) -> tuple[str, bool]:
+        """
+        Decode and store an image.
+
+        Parameters:
+        - image_bytes (bytes): The raw image data.
+
+        Returns:
+        - tuple[str, bool]: The image id and whether the image was newly decoded.
+        """
+        image_id = self.hash_bytes(image_bytes)
+        if self.cache.get(image_id) is not None:
+            return image_id, False
+
+        try:
+            image = Image.open(BytesIO(image_bytes)).convert("RGB")
+        except Exception as e:
+            raise ValueError(f"Failed to decode image: {e}")
+
+        nbytes = estimate_nbytes(image)
+        if nbytes > self.cache.max_bytes:
+            raise ValueError(f"Image of {image.width}x{image.height} is too large to keep")
+        self.cache.put(image_id, image, nbytes=nbytes)
+        return image_id, True
+
+    def get(self, image_id: str) -> Image.Image:
+        """Return the decoded RGB image for an id, raising KeyError if unknown or evicted."""
+        image = self.cache.get(image_id)
+        if image is None:
+            raise KeyError(f"Unknown image id: {image_id}")
+        return image
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.cache
+
+
+image_store = ImageStore()
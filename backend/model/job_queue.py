@@ -0,0 +1,220 @@
+import threading
+import queue
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job to abort it after cancellation was requested."""
+
+
+class Job:
+    """A unit of work run by the JobQueue worker. `fn` receives the job so it can poll cancellation."""
+
+    def __init__(self, fn, metadata: dict | None = None):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.metadata = metadata or {}
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.future = Future()
+        self.cancel_event = threading.Event()
+        # Progress events for streaming clients, trimmed to the most recent ones
+        self.events = []
+        self.event_seq = 0
+        self.events_lock = threading.Lock()
+        self.max_events = 32
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def publish(self, event: str, data: dict):
+        """Record a progress event (e.g. a preview) for streaming clients."""
+        with self.events_lock:
+            self.event_seq += 1
+            self.events.append({"seq": self.event_seq, "event": event, "data": data})
+            del self.events[:-self.max_events]
+
+    def events_since(self, seq: int) -> list[dict]:
+        with self.events_lock:
+            return [event for event in self.events if event["seq"] > seq]
+
+    def result(self):
+        return self.future.result()
+
+    def to_dict(self) -> dict:
+        wait = (self.started_at or time.time()) - self.created_at
+        run = None
+        if self.started_at is not None:
+            run = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "wait_seconds": wait,
+            "run_seconds": run,
+            "error": self.error,
+            **self.metadata
+        }
+
+
+# Every live queue, so metrics can report their depth
+_queues = weakref.WeakSet()
+
+
+def all_queues() -> list["JobQueue"]:
+    return list(_queues)
+
+
+class JobQueue:
+    """
+    Bounded FIFO of jobs drained by a single dedicated worker thread.
+
+    One worker means one generation at a time on the GPU, while the event loop
+    only waits on the job's future.
+    """
+
+    def __init__(self, max_size: int = 8, max_finished: int = 64, name: str = "jobs"):
+        self.name = name
+        self.max_size = max_size
+        self.max_finished = max_finished
+        self.queue = queue.Queue(maxsize=max_size)
+        self.jobs = OrderedDict()
+        self.wait_times = deque(maxlen=100)
+        self.lock = threading.Lock()
+        self.worker = None
+        self.running_job = None
+        _queues.add(self)
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self._run, name=f"{self.name}-worker", daemon=True)
+                self.worker.start()
+
+    def submit(self, fn, metadata: dict | None = None) -> Job:
+        """
+        Enqueue fn(job) for the worker.
+
+        Raises:
+        - QueueFull: if max_size jobs are already waiting.
+        """
+        self.start()
+        job = Job(fn, metadata)
+        with self.lock:
+            self.jobs[job.id] = job
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job.id]
+            raise QueueFull(f"{self.name} queue is full ({self.max_size} jobs waiting)")
+        return job
+
+    def add_finished(self, result, metadata: dict | None = None) -> Job:
+        """Record a job whose result is already known, e.g. from a cache, without running it."""
+        job = Job(None, metadata)
+        job.started_at = job.created_at
+        with self.lock:
+            self.jobs[job.id] = job
+            self._finish(job, "done", result=result)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self.lock:
+            if job_id not in self.jobs:
+                raise KeyError(f"Unknown job id: {job_id}")
+            return self.jobs[job_id]
+
+    def cancel(self, job_id: str) -> Job:
+        """Request cancellation. Queued jobs are skipped; running jobs stop at their next check."""
+        job = self.get(job_id)
+        job.cancel_event.set()
+        with self.lock:
+            if job.status == "queued":
+                self._finish(job, "cancelled", exception=JobCancelled(
+                    f"Job {job.id} was cancelled"))
+        return job
+
+    def position(self, job_id: str) -> int:
+        """Number of queued jobs ahead of this one, or 0 if it is not waiting."""
+        with self.lock:
+            queued = [job.id for job in self.jobs.values() if job.status == "queued"]
+        return queued.index(job_id) if job_id in queued else 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            waits = list(self.wait_times)
+        return {
+            "name": self.name,
+            "depth": self.queue.qsize(),
+            "max_size": self.max_size,
+            "running": self.running_job.id if self.running_job else None,
+            "jobs": counts,
+            "avg_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait_seconds": max(waits) if waits else 0.0
+        }
+
+    def _finish(self, job: Job, status: str, result=None, exception: Exception | None = None):
+        # Caller holds self.lock
+        if job.future.done():
+            return
+        job.status = status
+        job.finished_at = time.time()
+        if exception is not None:
+            job.error = str(exception)
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+        finished = [j.id for j in self.jobs.values()
+                    if j.status not in ("queued", "running")]
+        for old_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[old_id]
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                with self.lock:
+                    if job.cancelled or job.future.done():
+                        self._finish(job, "cancelled", exception=JobCancelled(
+                            f"Job {job.id} was cancelled"))
+                        continue
+                    job.status = "running"
+                    job.started_at = time.time()
+                    self.wait_times.append(job.started_at - job.created_at)
+                    self.running_job = job
+                try:
+                    result = job.fn(job)
+                except JobCancelled as e:
+                    with self.lock:
+                        self._finish(job, "cancelled", exception=e)
+                except Exception as e:
+                    with self.lock:
+                        self._finish(job, "failed", exception=e)
+                else:
+                    with self.lock:
+                        self._finish(job, "done", result=result)
+            finally:
+                with self.lock:
+                    self.running_job = None
+                self.queue.task_done()
@@ -0,0 +1,112 @@
+import base64
+import hashlib
+import math
+import numpy as np
+from model.cache import LRUCache
+
+MASK_ENCODINGS = {'bitpacked', 'rle'}
+# Most masks one payload may stack in front of (H, W)
+MAX_MASKS = 16
+
+
+def to_binary_mask(mask: np.ndarray) -> np.ndarray:
+    """Threshold a mask at 0.5 unless it is already boolean."""
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        return mask
+    return mask > 0.5
+
+
+def mask_hash(mask: np.ndarray) -> str:
+    """SHA-256 of a binary mask's bits and shape; also its id in the mask store."""
+    mask = to_binary_mask(mask)
+    digest = hashlib.sha256(np.packbits(mask.ravel()).tobytes())
+    digest.update(str(mask.shape).encode())
+    return digest.hexdigest()
+
+
+def encode_mask(mask: np.ndarray, encoding: str = 'bitpacked') -> dict:
+    """
+    Encode a binary mask compactly for transport.
+
+    Parameters:
+    - mask (np.ndarray): Mask of any shape. Non-boolean masks are thresholded at 0.5.
+    - encoding (str): 'bitpacked' (base64 of np.packbits, 1 bit per pixel) or
+        'rle' (row-major run lengths starting with a run of zeros).
+
+    Returns:
+    - dict: {"encoding", "shape", "data"} payload accepted by decode_mask.
+    """
+    mask = to_binary_mask(mask)
+    flat = mask.ravel()
+    if encoding == 'bitpacked':
+        data = base64.b64encode(np.packbits(flat).tobytes()).decode('ascii')
+    elif encoding == 'rle':
+        change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        bounds = np.concatenate([[0], change, [flat.size]])
+        counts = np.diff(bounds)
+        if flat.size and flat[0]:
+            counts = np.concatenate([[0], counts])
+        data = counts.tolist()
+    else:
+        raise ValueError(f"Unknown mask encoding: {encoding}")
+    return {"encoding": encoding, "shape": list(mask.shape), "data": data}
+
+
+def decode_mask(payload: dict, max_shape: tuple | None = None) -> np.ndarray:
+    """
+    Decode a payload produced by encode_mask back into a boolean array.
+
+    Parameters:
+    - max_shape (tuple): (height, width) the mask may not exceed, checked before
+        anything is allocated; at most MAX_MASKS masks may be stacked in front.
+
+    Raises:
+    - ValueError: if the shape is invalid or too large, or the data does not match it.
+    """
+    shape = tuple(int(dim) for dim in payload["shape"])
+    if not 2 <= len(shape) <= 4 or min(shape) <= 0:
+        raise ValueError(f"Invalid mask shape: {list(shape)}")
+    if max_shape is not None and (shape[-2] > max_shape[0] or shape[-1] > max_shape[1]
+                                  or math.prod(shape[:-2]) > MAX_MASKS):
+        raise ValueError(f"Mask shape {list(shape)} exceeds the image ({max_shape[0]}x{max_shape[1]})")
+    size = math.prod(shape)
+    encoding = payload["encoding"]
+    if encoding == 'bitpacked':
+        packed = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.uint8)
+        if len(packed) != (size + 7) // 8:
+            raise ValueError("Bit-packed data does not match the mask shape")
+        flat = np.unpackbits(packed, count=size).astype(bool)
+    elif encoding == 'rle':
+        counts = np.asarray(payload["data"], dtype=np.int64)
+        if counts.sum() != size:
+            raise ValueError("Run lengths do not match the mask shape")
+        values = (np.arange(len(counts)) % 2).astype(bool)
+        flat = np.repeat(values, counts)
+    else:
+        raise ValueError(f"Unknown mask encoding: {encoding}")
+    return flat.reshape(shape)
+
+
+class MaskStore:
+    """Server-side store of binary masks so clients only pass a mask id around."""
+
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        self.cache = LRUCache(max_bytes, name="masks")
+
+    def put(self, mask: np.ndarray) -> str:
+        mask = to_binary_mask(mask)
+        mask_id = mask_hash(mask)
+        if mask_id not in self.cache:
+            self.cache.put(mask_id, mask)
+        return mask_id
+
+    def get(self, mask_id: str) -> np.ndarray:
+        """Return the boolean mask for an id, raising KeyError if unknown or evicted."""
+        mask = self.cache.get(mask_id)
+        if mask is None:
+            raise KeyError(f"Unknown mask id: {mask_id}")
+        return mask
+
+
+mask_store = MaskStore()
@@ -0,0 +1,236 @@
+import resource
+import threading
+import time
+from contextlib import contextmanager
+import torch
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from model.cache import all_caches
+from model.job_queue import all_queues
+from model.registry import registry, host_memory_bytes, device_memory_bytes
+from model.placement import placement_manager
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Stages range from sub-millisecond mask ops to minute-long denoising
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MEMORY_BUCKETS = tuple(2 ** power for power in range(26, 36))  # 64 MiB to 32 GiB
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being handled")
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_duration_seconds", "Latency of individual pipeline stages",
+    ["stage"], buckets=LATENCY_BUCKETS)
+PEAK_DEVICE_BYTES = Histogram(
+    "request_peak_device_memory_bytes",
+    "Peak device memory allocated while handling a request (sampled when requests overlap)",
+    ["route"], buckets=MEMORY_BUCKETS)
+PEAK_HOST_BYTES = Histogram(
+    "request_peak_host_memory_bytes", "Largest resident set size sampled while handling a request",
+    ["route"], buckets=MEMORY_BUCKETS)
+
+
+def timed(stage: str):
+    """
+    Time a pipeline stage, as a context manager or decorator:
+
+        with timed("canny"):
+            ...
+
+        @timed("sam2_predict")
+        def predict(...):
+    """
+    return STAGE_SECONDS.labels(stage=stage).time()
+
+
+class MemoryWindow:
+    """Peak memory seen during one tracking window."""
+
+    def __init__(self, host: int, device: int, exact_device: bool):
+        self.host_peak = host
+        self.device_peak = device
+        self.exact_device = exact_device
+
+
+class PeakMemoryTracker:
+    """
+    Peak device and host memory of overlapping tracking windows.
+
+    While any window is open a background thread samples the process's resident set
+    size and allocated device memory every `interval` seconds, and each open window
+    keeps the largest values seen, including those at its start and end. Host spikes
+    shorter than the interval can be missed.
+
+    CUDA's own peak counter is process-wide: it is reset only by a window opening
+    while no other is open, and only that window reports it (an exact device peak).
+    Windows overlapping it, e.g. requests served while a stream is open, report the
+    sampled device peak instead of a peak inherited from other requests.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = set()
+        self.sampler = None
+
+    def enter(self) -> MemoryWindow:
+        host, device = host_memory_bytes(), device_memory_bytes()
+        with self.lock:
+            exact = not self.windows and torch.cuda.is_available()
+            if exact:
+                torch.cuda.reset_peak_memory_stats()
+            window = MemoryWindow(host, device, exact)
+            self.windows.add(window)
+            if self.sampler is None:
+                self.sampler = threading.Thread(
+                    target=self._sample, name="peak-memory-sampler", daemon=True)
+                self.sampler.start()
+        return window
+
+    def exit(self, window: MemoryWindow) -> tuple[int, int]:
+        """Close a window and return its (device, host) peak in bytes."""
+        host, device = host_memory_bytes(), device_memory_bytes()
+        with self.lock:
+            self.windows.discard(window)
+            window.host_peak = max(window.host_peak, host)
+            window.device_peak = max(window.device_peak, device)
+            if window.exact_device:
+                window.device_peak = max(window.device_peak, torch.cuda.max_memory_allocated())
+        return window.device_peak, window.host_peak
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            host, device = host_memory_bytes(), device_memory_bytes()
+            with self.lock:
+                if not self.windows:
+                    self.sampler = None
+                    return
+                for window in self.windows:
+                    window.host_peak = max(window.host_peak, host)
+                    window.device_peak = max(window.device_peak, device)
+
+
+peak_tracker = PeakMemoryTracker()
+
+
+@contextmanager
+def peak_memory(route: str):
+    """Record the peak device and host memory of the enclosed work under a route label."""
+    window = peak_tracker.enter()
+    try:
+        yield
+    finally:
+        device, host = peak_tracker.exit(window)
+        PEAK_DEVICE_BYTES.labels(route=route).observe(device)
+        PEAK_HOST_BYTES.labels(route=route).observe(host)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, in-flight count and peak memory per route.
+
+    Recording ends when the response body has been sent, not when its headers are
+    ready, so streamed responses (batch results, job events) are measured in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        window = peak_tracker.enter()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.dec()
+            device, host = peak_tracker.exit(window)
+            # Label by the route template, not the raw path, to keep ids out of the labels
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            REQUEST_SECONDS.labels(method=scope["method"], route=route,
+                                   status=str(status)).observe(elapsed)
+            PEAK_DEVICE_BYTES.labels(route=route).observe(device)
+            PEAK_HOST_BYTES.labels(route=route).observe(host)
+
+
+class PipelineCollector:
+    """Reads queue, cache, model and memory state at scrape time."""
+
+    def collect(self):
+        depth = GaugeMetricFamily("job_queue_depth", "Jobs waiting in the queue", labels=["queue"])
+        running = GaugeMetricFamily("job_queue_running", "Jobs currently running", labels=["queue"])
+        wait = GaugeMetricFamily("job_queue_avg_wait_seconds",
+                                 "Average wait of recently started jobs", labels=["queue"])
+        for job_queue in all_queues():
+            stats = job_queue.stats()
+            depth.add_metric([stats["name"]], stats["depth"])
+            running.add_metric([stats["name"]], 1 if stats["running"] else 0)
+            wait.add_metric([stats["name"]], stats["avg_wait_seconds"])
+        yield from (depth, running, wait)
+
+        hits = CounterMetricFamily("cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache misses", labels=["cache"])
+        hit_rate = GaugeMetricFamily("cache_hit_rate", "Cache hit rate", labels=["cache"])
+        cache_bytes = GaugeMetricFamily("cache_bytes", "Estimated bytes held", labels=["cache"])
+        for cache in all_caches():
+            stats = cache.stats()
+            hits.add_metric([stats["name"]], stats["hits"])
+            misses.add_metric([stats["name"]], stats["misses"])
+            hit_rate.add_metric([stats["name"]], stats["hit_rate"])
+            cache_bytes.add_metric([stats["name"]], stats["bytes"])
+        yield from (hits, misses, hit_rate, cache_bytes)
+
+        loaded = GaugeMetricFamily("model_loaded", "Whether the model is loaded", labels=["model"])
+        load_seconds = GaugeMetricFamily("model_load_seconds", "Time taken to load the model",
+                                         labels=["model"])
+        for name, status in registry.status().items():
+            loaded.add_metric([name], 1 if status["loaded"] else 0)
+            if "load_seconds" in status:
+                load_seconds.add_metric([name], status["load_seconds"])
+        yield from (loaded, load_seconds)
+
+        placement = placement_manager.status()
+        on_device = GaugeMetricFamily("model_on_device", "Whether the model is placed on the device",
+                                      labels=["model"])
+        for name, status in placement["models"].items():
+            on_device.add_metric([name], 1 if status["on_device"] else 0)
+        yield on_device
+        yield GaugeMetricFamily("placement_device_bytes", "Model bytes the placement manager has on the device",
+                                value=placement["device_bytes"])
+
+        yield GaugeMetricFamily("host_memory_bytes", "Resident set size of the process",
+                                value=host_memory_bytes())
+        yield GaugeMetricFamily("host_memory_peak_bytes", "Peak resident set size of the process",
+                                value=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        yield GaugeMetricFamily("device_memory_bytes", "Device memory currently allocated",
+                                value=device_memory_bytes())
+        if torch.cuda.is_available():
+            yield GaugeMetricFamily("device_memory_reserved_bytes",
+                                    "Device memory reserved by the caching allocator",
+                                    value=torch.cuda.memory_reserved())
+
+
+REGISTRY.register(PipelineCollector())
+
+
+def render() -> bytes:
+    """All metrics in the Prometheus text exposition format."""
+    return generate_latest(REGISTRY)
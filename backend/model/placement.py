@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def module_nbytes(module) -> int:
+    """Parameter and buffer bytes of a torch module, or of every module component of a pipeline."""
+    if isinstance(module, torch.nn.Module):
+        return sum(t.numel() * t.element_size()
+                   for t in list(module.parameters()) + list(module.buffers()))
+    components = getattr(module, "components", None)
+    if isinstance(components, dict):
+        return sum(module_nbytes(component) for component in components.values()
+                   if isinstance(component, torch.nn.Module))
+    return 0
+
+
+def default_budget(device: str) -> float:
+    """90% of the accelerator's memory; unlimited on the CPU."""
+    if str(device).startswith("cuda") and torch.cuda.is_available():
+        return 0.9 * torch.cuda.get_device_properties(torch.device(device)).total_memory
+    return float("inf")
+
+
+class PlacedModel:
+    def __init__(self, name: str, module, nbytes: int, priority: int, on_device: bool):
+        self.name = name
+        self.module = module
+        self.nbytes = nbytes
+        self.priority = priority
+        self.on_device = on_device
+        self.in_use = 0
+        self.last_used = 0.0
+
+
+class PlacementManager:
+    """
+    Decides which models are resident on the accelerator under a memory budget.
+
+    Models are registered with their footprint and a priority. Before a model runs,
+    use(name) moves it to the device; if that would exceed the budget, idle resident
+    models are moved to the host, lowest priority first and least recently used
+    within a priority. Models in use are never evicted; if they alone exceed the
+    budget, the model is placed anyway and the decision is recorded as over budget.
+
+    All moves happen here. With simulate=True no tensors move and only locations are
+    tracked, so the policy can be exercised on the CPU with a made-up budget.
+    """
+
+    def __init__(self, device: str = "cuda", budget_bytes: float | None = None,
+                 host: str = "cpu", simulate: bool = False, max_decisions: int = 200):
+        self.device = device
+        self.host = host
+        self.budget_bytes = budget_bytes if budget_bytes is not None else default_budget(device)
+        self.simulate = simulate
+        self.models = {}
+        self.decisions = deque(maxlen=max_decisions)
+        self.lock = threading.RLock()
+
+    def register(self, name: str, module, nbytes: int | None = None, priority: int = 0,
+                 on_device: bool = False):
+        """
+        Register a module (anything with .to(device)) that the manager will place.
+
+        Parameters:
+        - nbytes (int): Device footprint, default the module's parameter and buffer bytes.
+        - priority (int): Higher-priority models are evicted last.
+        - on_device (bool): Whether the module currently lives on the device.
+        """
+        with self.lock:
+            self.models[name] = PlacedModel(
+                name, module, nbytes if nbytes is not None else module_nbytes(module),
+                priority, on_device)
+            self._record("register", name, "on device" if on_device else "on host")
+
+    def device_bytes(self) -> int:
+        with self.lock:
+            return sum(model.nbytes for model in self.models.values() if model.on_device)
+
+    @contextmanager
+    def use(self, name: str):
+        """Keep a model on the device for the duration of the block."""
+        self.acquire(name)
+        try:
+            yield self.models[name].module
+        finally:
+            self.release(name)
+
+    def acquire(self, name: str):
+        with self.lock:
+            model = self.models[name]
+            model.in_use += 1
+            model.last_used = time.monotonic()
+            if model.on_device:
+                return
+            self._make_room(model)
+            self._move(model, to_device=True)
+            used = self.device_bytes()
+            if used > self.budget_bytes:
+                self._record("over_budget", name, f"{used} of {self.budget_bytes:.0f} bytes in use")
+            else:
+                self._record("load", name, "requested")
+
+    def release(self, name: str):
+        with self.lock:
+            model = self.models[name]
+            model.in_use -= 1
+            model.last_used = time.monotonic()
+
+    def offload(self, name: str):
+        """Move an idle model to the host now."""
+        with self.lock:
+            model = self.models[name]
+            if model.on_device and not model.in_use:
+                self._move(model, to_device=False)
+                self._record("evict", name, "offloaded on request")
+
+    def _make_room(self, incoming: PlacedModel):
+        # Caller holds self.lock
+        candidates = sorted(
+            (model for model in self.models.values()
+             if model.on_device and not model.in_use and model is not incoming),
+            key=lambda model: (model.priority, model.last_used))
+        for model in candidates:
+            if self.device_bytes() + incoming.nbytes <= self.budget_bytes:
+                return
+            self._move(model, to_device=False)
+            self._record("evict", model.name, f"making room for {incoming.name}")
+
+    def _move(self, model: PlacedModel, to_device: bool):
+        # Caller holds self.lock
+        if not self.simulate:
+            start = time.perf_counter()
+            model.module.to(self.device if to_device else self.host)
+            logger.info(f"Moved {model.name} to {self.device if to_device else self.host} "
+                        f"in {time.perf_counter() - start:.2f}s")
+        model.on_device = to_device
+
+    def _record(self, action: str, name: str, reason: str):
+        self.decisions.append({
+            "time": time.time(),
+            "action": action,
+            "model": name,
+            "reason": reason,
+            "device_bytes": self.device_bytes()
+        })
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "device": self.device,
+                "budget_bytes": self.budget_bytes if self.budget_bytes != float("inf") else None,
+                "device_bytes": self.device_bytes(),
+                "simulate": self.simulate,
+                "models": {
+                    model.name: {
+                        "on_device": model.on_device,
+                        "bytes": model.nbytes,
+                        "priority": model.priority,
+                        "in_use": model.in_use,
+                        "idle_seconds": time.monotonic() - model.last_used if model.last_used else None
+                    } for model in self.models.values()
+                },
+                "decisions": list(self.decisions)
+            }
+
+
+placement_manager = PlacementManager(device="cuda" if torch.cuda.is_available() else "cpu")
@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def host_memory_bytes() -> int:
+    """Resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def device_memory_bytes() -> int:
+    return torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+
+
+class ModelRegistry:
+    """
+    Loads each registered model on first use (or through warmup), exactly once.
+
+    Load time and the host/device memory growth during loading are recorded per model.
+    """
+
+    def __init__(self):
+        self.factories = {}
+        self.models = {}
+        self.load_stats = {}
+        self.load_locks = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, factory):
+        """Register a zero-argument callable that builds the model."""
+        with self.lock:
+            self.factories[name] = factory
+            self.load_locks[name] = threading.Lock()
+
+    def get(self, name: str):
+        if name in self.models:
+            return self.models[name]
+        if name not in self.factories:
+            raise KeyError(f"Unknown model: {name}")
+        with self.load_locks[name]:
+            # Another thread may have finished loading while we waited
+            if name in self.models:
+                return self.models[name]
+            logger.info(f"Loading model {name}...")
+            host_before = host_memory_bytes()
+            device_before = device_memory_bytes()
+            start = time.perf_counter()
+            model = self.factories[name]()
+            load_seconds = time.perf_counter() - start
+            self.load_stats[name] = {
+                "load_seconds": load_seconds,
+                "host_bytes": host_memory_bytes() - host_before,
+                "device_bytes": device_memory_bytes() - device_before
+            }
+            self.models[name] = model
+            logger.info(f"Loaded model {name} in {load_seconds:.1f}s.")
+            return model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self.models
+
+    def warmup(self, names: list[str] | None = None) -> dict:
+        """Load the given models (default: all registered) and return their status."""
+        for name in names if names is not None else list(self.factories):
+            self.get(name)
+        return self.status()
+
+    def status(self) -> dict:
+        return {
+            name: {"loaded": name in self.models, **self.load_stats.get(name, {})}
+            for name in self.factories
+        }
+
+
+registry = ModelRegistry()
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from model.cache import track_cache
+
+logger = logging.getLogger(__name__)
+
+RESULT_FILE = "result.json"
+IMAGE_REF = "__image__"
+
+
+def result_key(**fields) -> str:
+    """SHA-256 of the canonical JSON of everything that determines a result."""
+    payload = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value).__name__} in a result")
+
+
+class DiskResultCache:
+    """
+    Content-addressed store of finished results on local disk, bounded in bytes.
+
+    Each entry is a directory named by its key holding result.json, with every PIL
+    image in the stored dict/list structure written next to it as a lossless PNG.
+    Entries are evicted least recently used first; recency survives restarts through
+    the entries' modification times. Entries are written to a temporary directory
+    and renamed into place, so readers never see a partial entry.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 2 * 1024 ** 3, name: str = "results"):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.name = name
+        # key -> bytes on disk, least recently used first
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # PNG encoding and disk writes stay off the caller's (GPU worker's) thread
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-writer")
+        self._load_index()
+        track_cache(self)
+
+    def _load_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.directory.iterdir():
+            if path.name.startswith("."):
+                # Left over from an interrupted write
+                shutil.rmtree(path, ignore_errors=True)
+            elif (path / RESULT_FILE).is_file():
+                nbytes = sum(f.stat().st_size for f in path.iterdir())
+                entries.append((path.stat().st_mtime, path.name, nbytes))
+        for _, key, nbytes in sorted(entries):
+            self.entries[key] = nbytes
+            self.current_bytes += nbytes
+        self._evict()
+
+    def get(self, key: str):
+        """Return the stored result with its images decoded, or None."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        path = self.directory / key
+        try:
+            with open(path / RESULT_FILE) as f:
+                value = self._restore(json.load(f), path)
+            path.touch()
+        except (OSError, ValueError) as e:
+            # Evicted meanwhile or damaged on disk
+            logger.warning(f"Dropping result cache entry {key}: {e}")
+            self._remove(key)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        """Store a result made of dicts, lists, JSON scalars and PIL images."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+        staging = self.directory / f".{key}.{uuid.uuid4().hex}"
+        staging.mkdir(parents=True)
+        try:
+            with open(staging / RESULT_FILE, "w") as f:
+                json.dump(self._store(value, staging, []), f, default=_json_default)
+            nbytes = sum(f.stat().st_size for f in staging.iterdir())
+            with self.lock:
+                if nbytes > self.max_bytes or key in self.entries:
+                    return
+                staging.rename(self.directory / key)
+                self.entries[key] = nbytes
+                self.current_bytes += nbytes
+                self._evict()
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def put_async(self, key: str, value) -> Future:
+        """Store a result on the writer thread."""
+        future = self.writer.submit(self.put, key, value)
+        future.add_done_callback(
+            lambda f: f.exception() and logger.error(f"Failed to cache result {key}: {f.exception()}"))
+        return future
+
+    def _store(self, value, directory: Path, images: list):
+        if isinstance(value, Image.Image):
+            filename = f"{len(images)}.png"
+            value.save(directory / filename, format="PNG", compress_level=1)
+            images.append(filename)
+            return {IMAGE_REF: filename}
+        if isinstance(value, dict):
+            return {k: self._store(v, directory, images) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._store(v, directory, images) for v in value]
+        return value
+
+    def _restore(self, value, directory: Path):
+        if isinstance(value, dict):
+            if set(value) == {IMAGE_REF}:
+                with Image.open(directory / value[IMAGE_REF]) as image:
+                    image.load()
+                    return image
+            return {k: self._restore(v, directory) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._restore(v, directory) for v in value]
+        return value
+
+    def _evict(self):
+        # Caller holds self.lock
+        while self.current_bytes > self.max_bytes:
+            key, nbytes = self.entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+            shutil.rmtree(self.directory / key, ignore_errors=True)
+
+    def _remove(self, key: str):
+        with self.lock:
+            nbytes = self.entries.pop(key, None)
+            if nbytes is not None:
+                self.current_bytes -= nbytes
+        shutil.rmtree(self.directory / key, ignore_errors=True)
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            for key in self.entries:
+                shutil.rmtree(self.directory / key, ignore_errors=True)
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "directory": str(self.directory),
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
@@ -5,10 +5,14 @@ from PIL import Image
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 from torchvision.ops import box_convert
 import logging
+import threading
 import torch
 import cv2  # Ensure OpenCV is imported for the new function
-
-predictor = SAM2ImagePredictor.from_pretrained("facebook/sam2-hiera-tiny")
+from model.image_store import image_store
+from model.cache import LRUCache, estimate_nbytes
+from model.registry import registry
+from model.metrics import timed
+from model.placement import placement_manager
 
 
 def base64_to_image(base64_string):
@@ -16,76 +20,219 @@ def base64_to_image(base64_string):
     return image
 
 
+BLUE = (0, 0, 255)
+
+
+def mask_bbox(mask: np.ndarray):
+    """(top, bottom, left, right) bounds of the non-zero pixels of a 2D mask, or None if empty."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def overlay_weights(masks: np.ndarray, alphas: list[float]):
+    """
+    Combined overlay opacity of several masks, restricted to their union's bounding box.
+
+    Stacking masks one after another with opacity a_i leaves (1 - a_i) of the pixel
+    per mask, so the combined opacity is 1 - prod(1 - a_i * mask_i).
+
+    Returns:
+    - (bbox, weights): weights is a uint8 (0-255) array covering bbox, or (None, None)
+        if all masks are empty.
+    """
+    boxes = [(mask, alpha, mask_bbox(mask))
+             for mask, alpha in zip(masks, alphas) if alpha > 0]
+    boxes = [(mask, alpha, box) for mask, alpha, box in boxes if box is not None]
+    if not boxes:
+        return None, None
+    top = min(box[0] for _, _, box in boxes)
+    bottom = max(box[1] for _, _, box in boxes)
+    left = min(box[2] for _, _, box in boxes)
+    right = max(box[3] for _, _, box in boxes)
+
+    keep = np.ones((bottom - top, right - left), dtype=np.float32)
+    for mask, alpha, (t, b, l, r) in boxes:
+        sub = keep[t - top:b - top, l - left:r - left]
+        np.multiply(sub, 1 - alpha, out=sub, where=mask[t:b, l:r] != 0)
+    weights = ((1 - keep) * 255 + 0.5).astype(np.uint8)
+    return (top, bottom, left, right), weights
+
+
+def blend_masks(image: np.ndarray, masks: np.ndarray, alphas: list[float], color=BLUE,
+                in_place: bool = False) -> np.ndarray:
+    """
+    Blend a solid color into an (H, W, 3) uint8 image wherever masks are set.
+
+    Only pixels inside the masks' union bounding box are touched, one channel at a
+    time in 16-bit integer arithmetic. With in_place the image itself is modified
+    instead of a copy.
+    """
+    blended = image if in_place else np.array(image, dtype=np.uint8, copy=True)
+    bbox, weights = overlay_weights(masks, alphas)
+    if bbox is None:
+        return blended
+    top, bottom, left, right = bbox
+    region = blended[top:bottom, left:right]
+    weights = weights.astype(np.uint16)
+    inverse = 255 - weights
+    for channel, value in enumerate(color):
+        mixed = region[..., channel].astype(np.uint16)
+        mixed *= inverse
+        if value:
+            mixed += weights * np.uint16(value)
+        # Rounded division by 255: (x + 128 + ((x + 128) >> 8)) >> 8
+        mixed += 128
+        mixed += mixed >> 8
+        mixed >>= 8
+        region[..., channel] = mixed
+    return blended
+
+
+def mask_layer(masks: np.ndarray, alphas: list[float], color=BLUE) -> np.ndarray:
+    """RGBA (H, W, 4) uint8 overlay that reproduces blend_masks when alpha-composited over the image."""
+    height, width = masks.shape[-2:]
+    layer = np.zeros((height, width, 4), dtype=np.uint8)
+    layer[..., :3] = color
+    bbox, weights = overlay_weights(masks, alphas)
+    if bbox is not None:
+        top, bottom, left, right = bbox
+        layer[top:bottom, left:right, 3] = weights
+    return layer
+
+
+class SAM2State:
+    """Per-session SAM2 state: the current image, its embedding and the latest prediction."""
+
+    def __init__(self):
+        self.image_id = None
+        self.image = None
+        self.embedding = None
+        self.masks = None
+        self.scores = None
+        self.logits = None
+
+    def nbytes(self) -> int:
+        """Bytes of the prediction; the image and embedding belong to the shared stores."""
+        return estimate_nbytes([self.masks, self.scores, self.logits])
+
+
 class SAM2:
-    def __init__(self, model_name: str = "facebook/sam2-hiera-tiny"):
-        self.predictor = SAM2ImagePredictor.from_pretrained(model_name)
+    """
+    Shared SAM2 predictor. Per-client data lives in SAM2State objects; the predictor's
+    own image state is swapped to the caller's embedding under `lock`.
+    """
+
+    def __init__(self, model_name: str = "facebook/sam2-hiera-tiny",
+                 embedding_cache_bytes: int = 256 * 1024 ** 2):
+        # Loaded on the host; the placement manager moves it to the device when it runs
+        self.predictor = SAM2ImagePredictor.from_pretrained(model_name, device="cpu")
+        placement_manager.register("sam2", self.predictor.model, priority=3)
+        self.lock = threading.Lock()
+        # Image id whose embedding is currently loaded in the predictor
+        self.active_image_id = None
+        # Image encoder outputs keyed by image hash, so revisiting an image skips Hiera
+        self.embedding_cache = LRUCache(
+            embedding_cache_bytes, name="sam2_embeddings")
 
-    def set_image(self, image_bytes: bytes):
+    def set_image(self, state: SAM2State, image_id: str):
         """
-        Set the image from raw bytes.
+        Set the image from the shared image store.
 
         Parameters:
-        - image_bytes (bytes): The image data in bytes.
+        - state (SAM2State): The session's SAM2 state.
+        - image_id (str): The id returned by the image store. Setting the
+            current image again is a no-op.
         """
+        if image_id == state.image_id:
+            return
+        image = image_store.get(image_id)
         try:
-            self.image = Image.open(BytesIO(image_bytes))
-            self.predictor.set_image(self.image)
+            with self.lock:
+                embedding = self.embedding_cache.get(image_id)
+                if embedding is None:
+                    with placement_manager.use("sam2"), timed("sam2_image_encoder"):
+                        self.predictor.set_image(image)
+                    embedding = {
+                        "features": self.predictor._features,
+                        "orig_hw": list(self.predictor._orig_hw)
+                    }
+                    self.embedding_cache.put(image_id, embedding)
+                    self.active_image_id = image_id
         except Exception as e:
             raise ValueError(f"Failed to set image: {e}")
+        state.image_id = image_id
+        state.image = image
+        state.embedding = embedding
+        state.masks = state.scores = state.logits = None
 
-    def segment(self, coordinate: np.ndarray, label: np.ndarray):
-        image_width, image_height = self.image.size
+    def restore_embedding(self, cached: dict):
+        """Load cached image features into the predictor without rerunning the encoder."""
+        self.predictor.reset_predictor()
+        self.predictor._features = cached["features"]
+        self.predictor._orig_hw = list(cached["orig_hw"])
+        self.predictor._is_image_set = True
+        self.predictor._is_batch = False
+
+    def predict(self, state: SAM2State, **kwargs):
+        """Run the predictor on the session's image. Caller must not hold self.lock."""
+        if state.embedding is None:
+            raise ValueError("No image set")
+        with self.lock:
+            if self.active_image_id != state.image_id:
+                self.restore_embedding(state.embedding)
+                self.active_image_id = state.image_id
+            with placement_manager.use("sam2"), timed("sam2_predict"):
+                masks, scores, logits = self.predictor.predict(
+                    multimask_output=False, **kwargs)
+        state.masks = masks
+        state.scores = scores
+        state.logits = logits
+        return masks
+
+    def segment(self, state: SAM2State, coordinate: np.ndarray, label: np.ndarray):
+        image_width, image_height = state.image.size
         coordinate = coordinate * np.array([image_width, image_height])
-        masks, scores, logits = self.predictor.predict(
+        self.predict(
+            state,
             point_coords=coordinate.astype(np.int16),
-            point_labels=label,
-            multimask_output=False
+            point_labels=label
         )
-        self.masks = masks
-        self.scores = scores
-        self.logits = logits
         return coordinate
 
-    def segment_from_boxes(self, boxes: np.ndarray):
-        image_width, image_height = self.image.size
-        # First denormalize
-        boxes = torch.tensor(
-            boxes) * torch.tensor([image_width, image_height, image_width, image_height])
-
-        # Convert from (centerx, centery, w, h) to (x1, y1, w, h)
-        boxes_corner = torch.zeros_like(boxes)
-        boxes_corner[:, 0] = boxes[:, 0] - \
-            boxes[:, 2] / 2  # x1 = centerx - width/2
-        boxes_corner[:, 1] = boxes[:, 1] - \
-            boxes[:, 3] / 2  # y1 = centery - height/2
-        boxes_corner[:, 2:] = boxes[:, 2:]  # width and height remain same
+    def segment_from_boxes(self, state: SAM2State, boxes: np.ndarray | torch.Tensor):
+        """Segment from normalized (cx, cy, w, h) boxes, e.g. GroundingDINO output."""
+        image_width, image_height = state.image.size
+        # Denormalize and convert to corner format in one tensor op
+        boxes = torch.as_tensor(boxes, dtype=torch.float32) * torch.tensor(
+            [image_width, image_height, image_width, image_height])
+        xyxy = box_convert(boxes, "cxcywh", "xyxy")
+        self.segment_from_xyxy(state, xyxy)
+        return xyxy.numpy()
 
-        # Convert to xyxy format
-        xyxy = box_convert(boxes_corner, "xywh", "xyxy").numpy()
-
-        masks, scores, logits = self.predictor.predict(
+    def segment_from_xyxy(self, state: SAM2State, boxes: np.ndarray | torch.Tensor):
+        """Segment from pixel (x1, y1, x2, y2) boxes in a single batched prediction."""
+        return self.predict(
+            state,
             point_coords=None,
             point_labels=None,
-            box=xyxy,
-            multimask_output=False
+            box=boxes
         )
-        self.masks = masks
-        self.scores = scores
-        self.logits = logits
-        return xyxy
 
-    def show_mask(self, random_color=False, borders=True):
+    def show_mask(self, state: SAM2State, random_color=False, borders=True):
         if random_color:
             color = np.concatenate(
                 [np.random.random(3), np.array([0.6])], axis=0)
         else:
             color = np.array([30/255, 144/255, 255/255, 0.6])
-        h, w = self.masks.shape[-2:]
-        mask = self.masks.astype(np.uint8)
+        h, w = state.masks.shape[-2:]
+        mask = state.masks.astype(np.uint8)
         mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
         if borders:
             contours, _ = cv2.findContours(
-                self.masks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+                state.masks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
             # Try to smooth contours
             contours = [cv2.approxPolyDP(
                 contour, epsilon=0.01, closed=True) for contour in contours]
@@ -93,7 +240,7 @@ class SAM2:
                 mask_image, contours, -1, (1, 1, 1, 0.5), thickness=2)
         return mask_image
 
-    def apply_bluer_mask(self, alpha: float | list[float] = 0.5) -> np.ndarray:
+    def apply_bluer_mask(self, state: SAM2State, alpha: float | list[float] = 0.5) -> np.ndarray:
         """
         Apply semi-transparent blue overlays to the regions of the image where masks are 1.
 
@@ -105,23 +252,22 @@ class SAM2:
         Returns:
         - np.ndarray: The RGB image with blue overlays applied where masks == 1.
         """
-        # Ensure self.image is a NumPy array
-        if isinstance(self.image, Image.Image):
-            image_np = np.array(self.image)
-        elif isinstance(self.image, np.ndarray):
-            image_np = self.image
+        # Ensure the image is a NumPy array we are free to modify
+        if isinstance(state.image, Image.Image):
+            image_np = np.array(state.image)
+        elif isinstance(state.image, np.ndarray):
+            image_np = state.image.copy()
         else:
-            raise TypeError("self.image must be a PIL Image or a NumPy array")
+            raise TypeError("state.image must be a PIL Image or a NumPy array")
 
         # Handle different mask shapes
-        masks = self.masks
+        masks = state.masks
         if len(masks.shape) == 4:  # Shape is (N, 1, H, W)
             masks = masks.squeeze(1)  # Reshape to (N, H, W)
 
         if image_np.shape[2] != 3:
             raise ValueError("Image should have shape (H, W, 3)")
         if masks.shape[1:] != image_np.shape[:2]:
-            print(masks.shape[1:], image_np.shape[:2])
             raise ValueError("Mask and image spatial dimensions must match")
 
         # Handle alpha values
@@ -137,30 +283,26 @@ class SAM2:
         if not all(0 <= a <= 1 for a in alphas):
             raise ValueError("All alpha values must be between 0 and 1")
 
-        # Copy the image to avoid modifying the original
-        blended = image_np.copy().astype(np.float32)
-
-        # Create a blue overlay
-        blue_overlay = np.zeros_like(blended)
-        blue_overlay[:, :, 2] = 255  # Set blue channel to maximum
+        return blend_masks(image_np, masks, alphas, in_place=True)
 
-        # Apply overlay for each mask with its corresponding alpha
-        for mask, alpha in zip(masks, alphas):
-            mask_expanded = mask[:, :, np.newaxis]  # Shape: (H, W, 1)
-            blended = np.where(
-                mask_expanded == 1,
-                (1 - alpha) * blended + alpha * blue_overlay,
-                blended
-            )
+    def get_mask_layer(self, state: SAM2State, alpha: float | list[float] = 0.5) -> np.ndarray:
+        """Return only the RGBA blue overlay layer of the current masks, for client-side compositing."""
+        masks = state.masks
+        if len(masks.shape) == 4:
+            masks = masks.squeeze(1)
+        alphas = [alpha] * masks.shape[0] if isinstance(
+            alpha, (int, float)) else alpha
+        return mask_layer(masks, alphas)
 
-        # Ensure the pixel values are in the valid range
-        blended = np.clip(blended, 0, 255).astype(np.uint8)
+    def get_masks(self, state: SAM2State):
+        if state.masks is None:
+            raise ValueError("No masks yet, segment first")
+        return state.masks
 
-        return blended
 
-    def get_masks(self):
-        return self.masks
+# Loaded on first use or through /warmup
+registry.register("sam2", SAM2)
 
 
-# When creating the global instance, also move to GPU
-sam2_model = SAM2()
+def get_sam2_model() -> SAM2:
+    return registry.get("sam2")
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Session:
+    """
+    One client's model state (current image, embeddings, masks, detections).
+
+    Models themselves are shared; each model keeps its per-client state in a
+    state object stored here under the model's name. Hold `lock` while reading
+    or changing the session's state.
+    """
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.lock = threading.RLock()
+        self.states = {}
+        # Requests holding the session; guarded by the SessionManager's lock
+        self.in_use = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    def state(self, name: str, factory):
+        """Return the session's state for a model, creating it with factory() on first use."""
+        if name not in self.states:
+            self.states[name] = factory()
+        return self.states[name]
+
+    def nbytes(self) -> int:
+        """Bytes of data only this session holds, as reported by each state's nbytes()."""
+        return sum(state.nbytes() for state in self.states.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.id,
+            "models": list(self.states),
+            "bytes": self.nbytes(),
+            "in_use": self.in_use,
+            "idle_seconds": time.time() - self.last_used
+        }
+
+
+class SessionManager:
+    """
+    Creates sessions on demand and evicts them by TTL, then least-recently-used
+    first while over the session count or memory cap. Sessions that are in use
+    (acquired and not yet released, or locked) are never evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = 30 * 60, max_sessions: int = 64,
+                 max_bytes: int = 4 * 1024 ** 3):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, session_id: str) -> Session:
+        """
+        Return the session, creating it if needed, and protect it from eviction until
+        release(session) is called.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(session_id)
+                self.sessions[session_id] = session
+            session.in_use += 1
+            session.last_used = time.time()
+            self.sessions.move_to_end(session_id)
+            self._evict(keep=session_id)
+            return session
+
+    def release(self, session: Session):
+        with self.lock:
+            session.in_use -= 1
+            session.last_used = time.time()
+
+    def remove(self, session_id: str) -> bool:
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def _evict(self, keep: str):
+        # Caller holds self.lock
+        now = time.time()
+        for session_id in list(self.sessions):
+            session = self.sessions[session_id]
+            if session_id != keep and now - session.last_used > self.ttl_seconds:
+                self._try_remove(session)
+
+        total_bytes = sum(session.nbytes() for session in self.sessions.values())
+        for session_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions and total_bytes <= self.max_bytes:
+                break
+            if session_id == keep:
+                continue
+            session = self.sessions[session_id]
+            nbytes = session.nbytes()
+            if self._try_remove(session):
+                total_bytes -= nbytes
+
+    def _try_remove(self, session: Session) -> bool:
+        # Skip sessions with a request in flight
+        if session.in_use or not session.lock.acquire(blocking=False):
+            return False
+        try:
+            del self.sessions[session.id]
+            self.evictions += 1
+            return True
+        finally:
+            session.lock.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            sessions = [session.to_dict() for session in self.sessions.values()]
+        return {
+            "sessions": len(sessions),
+            "bytes": sum(session["bytes"] for session in sessions),
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": self.evictions,
+            "details": sessions
+        }
+
+
+session_manager = SessionManager()
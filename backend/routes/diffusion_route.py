@@ -1,12 +1,28 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse, Response
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import File, Form, UploadFile
 from pydantic import BaseModel
 from io import BytesIO
-from PIL import Image, ImageFilter
-from model.diffusion_pipline import inpainting_pipeline, make_canny_condition
+from PIL import Image
+from model.diffusion_pipline import get_inpainting_pipeline, latents_to_previews, \
+    prepare_mask, resolve_sampling, model_identity, AdvancedInpaintingPipeline, InpaintingState
+from model.image_store import image_store
+from model.mask_store import mask_store, decode_mask, mask_hash
+from model.job_queue import Job, JobQueue, JobCancelled, QueueFull
+from model.batch_scheduler import BatchScheduler
+from model.result_cache import DiskResultCache, result_key
+from concurrent.futures import Future
+from routes.encoding import EncodingOptions, encoding_options, encode_image, image_response
+from routes.session import get_session
+from model.session import Session
+from model.metrics import timed, peak_memory
 import numpy as np
+import asyncio
+import base64
+import json
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -18,9 +34,9 @@ async def root():
 
 
 @router.post("/set_image")
-async def set_image(image: UploadFile = File(...)):
+def set_image(image: UploadFile = File(...), session: Session = Depends(get_session)):
     """
-    Endpoint to add an image to the SAM2 model.
+    Endpoint to set the session's source image for inpainting.
 
     Parameters:
     - image (UploadFile): The image file uploaded by the user.
@@ -37,144 +53,660 @@ async def set_image(image: UploadFile = File(...)):
                 status_code=400, detail="Invalid image format.")
 
         # read the image
-        image_bytes = await image.read()
-        await image.close()
+        image_bytes = image.file.read()
+        image.file.close()
 
-        inpainting_pipeline.set_image(image_bytes)
+        image_id, _ = image_store.put(image_bytes)
+        with session.lock:
+            AdvancedInpaintingPipeline.set_image(
+                inpainting_state(session), image_id)
         logger.info("Diffusion route: Image set successfully.")
-        return JSONResponse(content={"message": "Diffusion route: Image set successfully"}, status_code=200)
+        return JSONResponse(content={"message": "Diffusion route: Image set successfully", "image_id": image_id}, status_code=200)
     except Exception as e:
         logger.error(f"Diffusion route: Error setting image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def convert_binary_mask_to_PIL(mask: np.ndarray):
-    """Convert mask to binary mask and then to PIL Image.
+class EncodedMask(BaseModel):
+    encoding: str  # 'bitpacked' or 'rle'
+    shape: list[int]
+    data: str | list[int]
 
-    Args:
-        mask: Mask array of shape (1, H, W). If not binary, will be thresholded at 0.5
 
-    Returns:
-        PIL Image with shape (H, W, 3) where 1s are converted to 255
-    """
-    # Ensure mask is binary
-    if not np.array_equal(mask, mask.astype(bool)):
-        # If mask contains values other than 0 and 1, threshold at 0.5
-        mask = (mask > 0.5).astype(np.float32)
-
-    # Remove single channel dimension and expand to 3 channels
-    mask = mask.squeeze(0)  # (H, W)
-    mask = np.stack([mask] * 3, axis=-1)  # (H, W, 3)
-    # Convert 1s to 255
-    mask = (mask * 255).astype(np.uint8)
-    return Image.fromarray(mask).convert("RGB")
+# Soft edge (Gaussian sigma, pixels) of the final blend when is_applying_blur is set
+FEATHER_RADIUS = 10
 
 
 class InpaintingRequest(BaseModel):
     prompt: str
-    mask: list  # Change this to accept a list instead of np.ndarray
+    negative_prompt: str | None = None
+    # Exactly one of mask_id (preferred), mask_data or the legacy nested list
+    mask: list | None = None
+    mask_id: str | None = None
+    mask_data: EncodedMask | None = None
     postprocess_mode: bool
     is_applying_blur: bool
     using_canny_control_image: bool
-    num_inference_steps: int
-    guidance_scale: float
+    canny_low_threshold: int = 100
+    canny_high_threshold: int = 200
+    # Sampling: explicit values win over the preset ('draft', 'balanced', 'final')
+    preset: str | None = None
+    scheduler: str | None = None  # 'ddim', 'euler' or 'dpmpp'
+    num_inference_steps: int | None = None
+    guidance_scale: float | None = None
+    eta: float = 0.0
     controlnet_conditioning_scale: float
     num_samples: int
     mask_rescale: float
+    image_id: str | None = None
+    seed: int | None = None  # Candidate i uses seed + i
+    batch_size: int | None = None  # Candidates per denoising pass, default all
+    return_candidates: bool = False
+    preview_every: int = 0  # Publish a latent preview every k steps, 0 disables
+    region_mode: bool = False  # Only diffuse a padded crop around the mask
+    region_padding: float = 0.25
+    # Rank candidates after this fraction of the steps and only finish the keep_top best
+    prune_at: float | None = None
+    keep_top: int = 1
 
     class Config:
         arbitrary_types_allowed = True
 
 
-def resize_and_crop_center(image: Image.Image, k: float) -> Image.Image:
+class BatchInpaintingItem(BaseModel):
+    """One image of a batch request; items with the same model size and sampling settings share GPU batches."""
+    item_id: str | None = None  # Echoed back to match streamed results
+    image_id: str
+    prompt: str
+    negative_prompt: str | None = None
+    mask: list | None = None
+    mask_id: str | None = None
+    mask_data: EncodedMask | None = None
+    seed: int | None = None
+    mask_rescale: float = 1.0
+    is_applying_blur: bool = False
+    using_canny_control_image: bool = False
+    canny_low_threshold: int = 100
+    canny_high_threshold: int = 200
+    postprocess_mode: bool = False
+    model_size: int = 1024
+    preset: str | None = None
+    scheduler: str | None = None
+    num_inference_steps: int | None = None
+    guidance_scale: float | None = None
+    eta: float = 0.0
+    controlnet_conditioning_scale: float = 0.2
+    region_mode: bool = False
+    region_padding: float = 0.25
+
+
+class BatchInpaintingRequest(BaseModel):
+    items: list[BatchInpaintingItem]
+
+
+def image_to_base64(image: Image.Image, format: str = 'PNG') -> str:
+    buffer = BytesIO()
+    image.save(buffer, format=format)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def resolve_mask(request: InpaintingRequest | BatchInpaintingItem, image_size: tuple) -> np.ndarray:
     """
-    Resize image by factor k and handle the result to match original size.
-    If k > 1: crops the center region
-    If k < 1: pads the borders with black
-
-    Args:
-        image: PIL Image object
-        k: scaling factor (must be > 0)
+    Return the request's mask as a (1, H, W) array, merging multiple masks into one.
 
-    Returns:
-        PIL Image with original size
+    Client-encoded masks may not be larger than the source image (width, height).
     """
-    if k <= 0:
-        raise ValueError("Scale factor k must be greater than 0")
-    # Get original dimensions
-    original_width, original_height = image.size
+    try:
+        if request.mask_id is not None:
+            mask = mask_store.get(request.mask_id)
+        elif request.mask_data is not None:
+            width, height = image_size
+            mask = decode_mask(request.mask_data.model_dump(), max_shape=(height, width))
+        elif request.mask is not None:
+            mask = np.array(request.mask)
+        else:
+            raise HTTPException(
+                status_code=400, detail="One of mask_id, mask_data or mask is required.")
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if mask.ndim < 2:
+        raise HTTPException(
+            status_code=400, detail=f"Mask must have at least 2 dimensions, got shape {mask.shape}.")
+    if mask.ndim >= 3:
+        # Several masks of shape (N, H, W) or (N, 1, H, W): inpaint their union
+        mask = (mask > 0.5).reshape(-1, *mask.shape[-2:]).any(axis=0)
+    return mask.reshape(1, *mask.shape[-2:])
+
+
+def with_sampling(request: InpaintingRequest | BatchInpaintingItem):
+    """Copy of the request with its preset, scheduler, steps and guidance resolved."""
+    try:
+        sampling = resolve_sampling(
+            request.preset,
+            scheduler=request.scheduler,
+            num_inference_steps=request.num_inference_steps,
+            guidance_scale=request.guidance_scale
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return request.model_copy(update=sampling)
 
-    # Calculate new dimensions
-    new_width = int(original_width * k)
-    new_height = int(original_height * k)
 
-    # Resize image
-    resized_image = image.resize(
-        (new_width, new_height), Image.Resampling.LANCZOS)
+# Finished results of seeded requests on local disk, served again without the GPU
+result_cache = DiskResultCache("cache/results", max_bytes=2 * 1024 ** 3, name="inpainting_results")
+# Request fields that do not change the generated result; image and mask enter by hash
+NON_RESULT_FIELDS = {"item_id", "image_id", "mask", "mask_id", "mask_data", "preview_every"}
 
-    if k >= 1:
-        # Calculate crop coordinates
-        left = (new_width - original_width) // 2
-        top = (new_height - original_height) // 2
-        right = left + original_width
-        bottom = top + original_height
 
-        # Crop center region
-        result_image = resized_image.crop((left, top, right, bottom))
-    else:
-        # Create black background
-        result_array = np.zeros(
-            (original_height, original_width, 3), dtype=np.uint8)
-        result_image = Image.fromarray(result_array)
+def result_cache_key(kind: str, request: InpaintingRequest | BatchInpaintingItem,
+                     image_id: str, mask_array: np.ndarray) -> str | None:
+    """
+    Result cache key of a resolved request, or None if it cannot be cached.
+
+    Only seeded requests are reproducible. The key covers the image and mask hashes,
+    every generation parameter (prompt, sampling, post-processing, seed, ...) and
+    the identity of the weights, so changing any of them misses the cache.
+    """
+    if request.seed is None:
+        return None
+    return result_key(
+        kind=kind,
+        image=image_id,
+        mask=mask_hash(mask_array),
+        params=request.model_dump(exclude=NON_RESULT_FIELDS),
+        models=model_identity()
+    )
 
-        # Calculate paste coordinates
-        left = (original_width - new_width) // 2
-        top = (original_height - new_height) // 2
 
-        # Paste resized image onto black background
-        result_image.paste(resized_image, (left, top))
+def inpainting_state(session: Session) -> InpaintingState:
+    return session.state("inpainting", InpaintingState)
 
-    return result_image
 
+def prepare_inpainting(request: InpaintingRequest, session: Session) -> tuple[str, Image.Image, np.ndarray]:
+    """
+    Resolve the request's source image and mask up front so bad input fails before queueing.
 
-@router.post("/inpainting")
-async def inpainting(request: InpaintingRequest):
+    Returns:
+    - tuple: (image_id, source image, (1, H, W) mask)
+    """
+    with session.lock:
+        state = inpainting_state(session)
+        if request.image_id is not None:
+            try:
+                AdvancedInpaintingPipeline.set_image(state, request.image_id)
+            except KeyError as e:
+                raise HTTPException(status_code=404, detail=str(e))
+        image_id, source = state.image_id, state.source_image
+    if source is None:
+        raise HTTPException(status_code=400, detail="No image set.")
+    if request.mask_rescale <= 0:
+        raise HTTPException(
+            status_code=400, detail="mask_rescale must be greater than 0.")
+    if request.prune_at is not None and not 0 < request.prune_at < 1:
+        raise HTTPException(
+            status_code=400, detail="prune_at must be between 0 and 1.")
+    if request.keep_top < 1:
+        raise HTTPException(
+            status_code=400, detail="keep_top must be at least 1.")
+    return image_id, source, resolve_mask(request, source.size)
+
+
+def make_step_callback(request: InpaintingRequest, job: Job):
+    """Abort on cancellation and publish progress, plus a preview every `preview_every` steps."""
+    def on_step(step, timestep, latents):
+        job.raise_if_cancelled()
+        step = step + 1
+        job.publish("progress", {"step": step,
+                    "total": request.num_inference_steps})
+        if request.preview_every > 0 and step % request.preview_every == 0:
+            previews = latents_to_previews(latents)
+            job.publish("preview", {
+                "step": step,
+                "images": [image_to_base64(preview, 'JPEG') for preview in previews]
+            })
+    return on_step
+
+
+@peak_memory("inpainting_job")
+def run_inpainting(request: InpaintingRequest, image_id: str, source: Image.Image, mask_array: np.ndarray,
+                   job: Job) -> dict:
+    """Run one inpainting request on the GPU worker."""
+    inpainting_pipeline = get_inpainting_pipeline()
     prompt = request.prompt
-    source = inpainting_pipeline.source_image
-    # Convert the list back to numpy array
-    mask_array = np.array(request.mask)
-    mask = convert_binary_mask_to_PIL(mask_array)
-    mask = resize_and_crop_center(mask, request.mask_rescale)
-    if request.is_applying_blur:
-        mask = mask.filter(ImageFilter.GaussianBlur(radius=10))
+    with timed("mask_prep"):
+        mask, feather = prepare_mask(
+            mask_array, request.mask_rescale,
+            feather_radius=FEATHER_RADIUS if request.is_applying_blur else 0,
+            size=source.size)
+    canny_thresholds = None
     if request.using_canny_control_image:
-        control_image = make_canny_condition(source)
-    else:
-        control_image = None
+        canny_thresholds = (request.canny_low_threshold, request.canny_high_threshold)
 
-    result, clip_score = inpainting_pipeline.inpaint(
+    job.raise_if_cancelled()
+    result, clip_score, candidates = inpainting_pipeline.inpaint(
         image=source,
         mask=mask,
         prompt=prompt,
-        control_image=control_image,
+        negative_prompt=request.negative_prompt,
+        canny_thresholds=canny_thresholds,
+        cache_key=image_id,
+        scheduler=request.scheduler,
         num_inference_steps=request.num_inference_steps,
         guidance_scale=request.guidance_scale,
+        eta=request.eta,
         controlnet_conditioning_scale=request.controlnet_conditioning_scale,
-        num_samples=request.num_samples  # Generate 3 samples and pick the best
+        num_samples=request.num_samples,  # Generate N samples and pick the best
+        seed=request.seed,
+        batch_size=request.batch_size,
+        return_candidates=True,
+        step_callback=make_step_callback(request, job),
+        region_mode=request.region_mode,
+        region_padding=request.region_padding,
+        blend_mask=feather,
+        prune_at=request.prune_at,
+        keep_top=request.keep_top
+    )
+    steps_saved = request.num_samples * request.num_inference_steps - \
+        sum(candidate["steps"] for candidate in candidates)
+
+    # Color correction weighted by the same (feathered) mask the result was blended with
+    color_mask = feather if feather is not None else mask
+    with timed("color_match"):
+        if request.postprocess_mode:
+            final_result = inpainting_pipeline.post_process(result, source, color_mask)
+        else:
+            final_result = result
+
+        if request.return_candidates:
+            for candidate in candidates:
+                candidate["is_best"] = candidate["image"] is result
+                if request.postprocess_mode and not candidate["pruned"]:
+                    candidate["image"] = inpainting_pipeline.post_process(
+                        candidate["image"], source, color_mask)
+    return {"image": final_result, "score": clip_score, "candidates": candidates,
+            "steps_saved": steps_saved}
+
+
+def check_image_format(options: EncodingOptions):
+    """Reject formats inpainting cannot return, before any work is queued."""
+    if options.format == 'mask':
+        raise HTTPException(
+            status_code=400, detail="format=mask is only available for segmentation.")
+
+
+def encode_candidate(candidate: dict, options: EncodingOptions) -> dict:
+    content = {
+        "image": None,
+        "score": candidate["score"],
+        "seed": candidate["seed"],
+        "is_best": candidate["is_best"],
+        "pruned": candidate["pruned"],
+        "preview_score": candidate["preview_score"]
+    }
+    if not candidate["pruned"]:
+        image, stats = encode_image(candidate["image"], options)
+        content["image"] = base64.b64encode(image).decode('ascii')
+        content["encoding"] = stats
+    return content
+
+
+def inpainting_response(result: dict, return_candidates: bool, options: EncodingOptions,
+                        cache_status: str = "bypass") -> Response:
+    check_image_format(options)
+    if return_candidates:
+        content = [encode_candidate(candidate, options) for candidate in result["candidates"]]
+        return JSONResponse(content={"candidates": content, "best_score": result["score"],
+                                     "steps_saved": result["steps_saved"]},
+                            headers={"X-Result-Cache": cache_status})
+    response = image_response(result["image"], options)
+    response.headers["X-Steps-Saved"] = str(result["steps_saved"])
+    response.headers["X-Result-Cache"] = cache_status
+    return response
+
+
+# A single worker owns the GPU; the event loop only waits on job futures
+inpainting_queue = JobQueue(max_size=8, name="inpainting")
+# Queued or running jobs by result cache key, so a double submit joins the first job
+pending_results = {}
+pending_lock = threading.Lock()
+
+
+def queue_inpainting(run, metadata: dict) -> Job:
+    """Submit to the GPU worker, answering 503 when its queue is full."""
+    try:
+        return inpainting_queue.submit(run, metadata={**metadata, "submitters": 1})
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": "5"})
+
+
+def submit_inpainting(request: InpaintingRequest, session: Session) -> Job:
+    """
+    Queue a request, or answer it from the result cache.
+
+    Seeded requests that were generated before come back as an already finished
+    job; a seeded request identical to one still queued or running shares its job,
+    which from then on cannot be cancelled. Runs in a worker thread: it takes the
+    session lock and may decode cached results from disk.
+    """
+    request = with_sampling(request)
+    image_id, source, mask_array = prepare_inpainting(request, session)
+    key = result_cache_key("inpainting", request, image_id, mask_array)
+    metadata = {"kind": "inpainting", "return_candidates": request.return_candidates,
+                "result_cache": "bypass" if key is None else "miss"}
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return inpainting_queue.add_finished(cached, {**metadata, "result_cache": "hit"})
+
+    def run(job: Job) -> dict:
+        result = run_inpainting(request, image_id, source, mask_array, job)
+        if key is not None:
+            result_cache.put_async(key, result)
+        return result
+
+    if key is None:
+        return queue_inpainting(run, metadata)
+    # Look up, submit and register in one step, so simultaneous duplicates share one job
+    with pending_lock:
+        job = pending_results.get(key)
+        if job is not None and not job.future.done() and not job.cancelled:
+            # Shared jobs cannot be cancelled, since another client waits on them too
+            job.metadata["submitters"] += 1
+            return job
+        job = queue_inpainting(run, metadata)
+        pending_results[key] = job
+
+    def forget(_):
+        with pending_lock:
+            if pending_results.get(key) is job:
+                del pending_results[key]
+    # Registered outside the lock: it runs right away if the job already finished
+    job.future.add_done_callback(forget)
+    return job
+
+
+@router.post("/inpainting")
+async def inpainting(request: InpaintingRequest, options: EncodingOptions = Depends(encoding_options),
+                     session: Session = Depends(get_session)):
+    check_image_format(options)
+    # Resolving the request takes the session lock and decodes the mask; keep both off the loop
+    job = await asyncio.to_thread(submit_inpainting, request, session)
+    try:
+        result = await asyncio.wrap_future(job.future)
+    except JobCancelled as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Diffusion route: Error inpainting: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    # Encoding a full-resolution result is CPU work too
+    return await asyncio.to_thread(inpainting_response, result, request.return_candidates,
+                                   options, job.metadata["result_cache"])
+
+
+@router.post("/jobs")
+async def submit_job(request: InpaintingRequest, session: Session = Depends(get_session)):
+    """Queue an inpainting request and return its job id immediately."""
+    job = await asyncio.to_thread(submit_inpainting, request, session)
+    return JSONResponse(content={
+        "job_id": job.id,
+        "status": job.status,
+        "position": inpainting_queue.position(job.id)
+    }, status_code=202)
+
+
+@router.get("/jobs/stats")
+async def job_stats():
+    return inpainting_queue.stats()
+
+
+def get_job(job_id: str) -> Job:
+    try:
+        return inpainting_queue.get(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    content = job.to_dict()
+    content["position"] = inpainting_queue.position(job_id)
+    return content
+
+
+@router.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, options: EncodingOptions = Depends(encoding_options)):
+    job = get_job(job_id)
+    if job.status in ("queued", "running"):
+        raise HTTPException(
+            status_code=409, detail=f"Job {job_id} is {job.status}.")
+    if job.status != "done":
+        raise HTTPException(
+            status_code=410, detail=f"Job {job_id} {job.status}: {job.error}")
+    if job.metadata.get("kind") != "inpainting":
+        raise HTTPException(
+            status_code=409, detail=f"Job {job_id} is a batch; its results stream from /batch.")
+    return await asyncio.to_thread(inpainting_response, job.result(),
+                                   job.metadata["return_candidates"], options,
+                                   job.metadata["result_cache"])
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events with progress and previews until the job finishes."""
+    job = get_job(job_id)
+
+    async def stream():
+        seq = 0
+        while True:
+            done = job.future.done()
+            for event in job.events_since(seq):
+                seq = event["seq"]
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+            if done:
+                yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+                return
+            await asyncio.sleep(0.1)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = get_job(job_id)
+    if job.metadata.get("submitters", 1) > 1:
+        raise HTTPException(
+            status_code=409, detail=f"Job {job_id} is shared by identical requests and cannot be cancelled.")
+    try:
+        job = inpainting_queue.cancel(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+
+# Dynamic batching: compatible items from all batch requests are grouped for up to
+# BATCH_WINDOW_SECONDS, BATCH_MAX_SIZE images per denoising pass
+BATCH_MAX_SIZE = 4
+BATCH_WINDOW_SECONDS = 0.25
+MAX_BATCH_ITEMS = 256
+
+
+def batch_key(payload: dict) -> tuple:
+    """Items can share a denoising pass when these settings match."""
+    item = payload["item"]
+    return (item.model_size, item.scheduler, item.num_inference_steps,
+            item.guidance_scale, item.eta, item.controlnet_conditioning_scale)
+
+
+@peak_memory("inpainting_batch")
+def run_inpainting_batch(payloads: list[dict], job: Job) -> list[dict]:
+    """Run one scheduled batch on the GPU worker."""
+    inpainting_pipeline = get_inpainting_pipeline()
+    items = []
+    for payload in payloads:
+        item, source = payload["item"], payload["source"]
+        with timed("mask_prep"):
+            mask, feather = prepare_mask(
+                payload["mask"], item.mask_rescale,
+                feather_radius=FEATHER_RADIUS if item.is_applying_blur else 0,
+                size=source.size)
+        items.append({
+            "image": source,
+            "mask": mask,
+            "prompt": item.prompt,
+            "negative_prompt": item.negative_prompt,
+            "seed": item.seed,
+            "region_mode": item.region_mode,
+            "region_padding": item.region_padding,
+            "blend_mask": feather,
+            "canny_thresholds": (item.canny_low_threshold, item.canny_high_threshold)
+            if item.using_canny_control_image else None,
+            "cache_key": item.image_id
+        })
+
+    first = payloads[0]["item"]
+    job.raise_if_cancelled()
+    results = inpainting_pipeline.inpaint_batch(
+        items,
+        model_size=first.model_size,
+        scheduler=first.scheduler,
+        num_inference_steps=first.num_inference_steps,
+        guidance_scale=first.guidance_scale,
+        eta=first.eta,
+        controlnet_conditioning_scale=first.controlnet_conditioning_scale,
+        step_callback=lambda step, timestep, latents: job.raise_if_cancelled()
     )
 
-    if request.postprocess_mode:
-        final_result = inpainting_pipeline.post_process(result, source)
-    else:
-        final_result = result
+    with timed("color_match"):
+        for payload, item, result in zip(payloads, items, results):
+            if payload["item"].postprocess_mode:
+                color_mask = item["blend_mask"] if item["blend_mask"] is not None else item["mask"]
+                result["image"] = inpainting_pipeline.post_process(
+                    result["image"], payload["source"], color_mask)
+
+    for payload, result in zip(payloads, results):
+        if payload["cache_key"] is not None:
+            result_cache.put_async(payload["cache_key"], result)
+    return results
+
+
+def dispatch_batch(payloads: list[dict]) -> list[dict]:
+    """Hand a scheduled batch to the GPU worker, waiting for room in its queue."""
+    while True:
+        try:
+            job = inpainting_queue.submit(
+                lambda job: run_inpainting_batch(payloads, job),
+                metadata={"kind": "batch", "items": len(payloads)}
+            )
+            break
+        except QueueFull:
+            time.sleep(0.5)
+    return job.future.result()
+
 
-    # Create a byte stream to hold the image data
-    img_byte_arr = BytesIO()
+batch_scheduler = BatchScheduler(
+    dispatch_batch, batch_key, max_batch_size=BATCH_MAX_SIZE,
+    max_wait_seconds=BATCH_WINDOW_SECONDS, name="inpainting_batches")
 
-    # Save the image as PNG to the byte stream
-    final_result.save(img_byte_arr, format='PNG')
 
-    # Get the byte string from the stream
-    img_byte_arr = img_byte_arr.getvalue()
+def prepare_batch(items: list[BatchInpaintingItem]) -> list[dict]:
+    """
+    Validate batch items and build their scheduler payloads, in a worker thread.
+
+    Resolving presets, masks and hashes and reading the result cache is CPU and disk
+    work for up to MAX_BATCH_ITEMS items; each payload's "result" is its cached
+    result, or None when the item has to be generated.
+    """
+    payloads = []
+    for item in items:
+        item = with_sampling(item)
+        try:
+            source = image_store.get(item.image_id)
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        if item.mask_rescale <= 0:
+            raise HTTPException(
+                status_code=400, detail="mask_rescale must be greater than 0.")
+        mask = resolve_mask(item, source.size)
+        payloads.append({"item": item, "source": source, "mask": mask,
+                         "cache_key": result_cache_key("batch", item, item.image_id, mask)})
+    for payload in payloads:
+        key = payload["cache_key"]
+        payload["result"] = result_cache.get(key) if key is not None else None
+    return payloads
+
+
+@router.post("/batch")
+async def batch_inpainting(request: BatchInpaintingRequest,
+                           options: EncodingOptions = Depends(encoding_options)):
+    """
+    Inpaint many (image, mask, prompt) items.
 
-    return Response(content=img_byte_arr, media_type="image/png")
+    Items are validated up front, then scheduled together with compatible items of
+    concurrent batch requests; seeded items generated before come from the result
+    cache. Results stream back as NDJSON, one line per item in completion order:
+    {"index", "item_id", "status", "score", "seed", "cached", "image", "encoding"} on
+    success or {"index", "item_id", "status": "failed", "error"}.
+    """
+    check_image_format(options)
+    if not 0 < len(request.items) <= MAX_BATCH_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"A batch takes 1 to {MAX_BATCH_ITEMS} items.")
+
+    payloads = await asyncio.to_thread(prepare_batch, request.items)
+
+    pending = {}
+    cached = set()
+    for index, payload in enumerate(payloads):
+        if payload["result"] is not None:
+            future = Future()
+            future.set_result(payload["result"])
+            cached.add(index)
+        else:
+            future = batch_scheduler.submit(payload)
+        pending[asyncio.wrap_future(future)] = index
+
+    async def stream():
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = pending.pop(task)
+                line = {"index": index, "item_id": request.items[index].item_id}
+                try:
+                    result = task.result()
+                    content, stats = await asyncio.to_thread(encode_image, result["image"], options)
+                    line.update({
+                        "status": "done",
+                        "score": result["score"],
+                        "seed": result["seed"],
+                        "cached": index in cached,
+                        "image": base64.b64encode(content).decode('ascii'),
+                        "encoding": stats
+                    })
+                except Exception as e:
+                    logger.error(f"Diffusion route: Error in batch item {index}: {str(e)}")
+                    line.update({"status": "failed", "error": str(e)})
+                yield json.dumps(line) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@router.get("/batch/stats")
+async def batch_stats():
+    return batch_scheduler.stats()
+
+
+@router.get("/results/stats")
+async def result_cache_stats():
+    return result_cache.stats()
+
+
+@router.delete("/results")
+async def clear_result_cache():
+    result_cache.clear()
+    return result_cache.stats()
@@ -0,0 +1,123 @@
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+from io import BytesIO
+from PIL import Image
+import numpy as np
+from model.metrics import STAGE_SECONDS
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'mask': 'image/png'
+}
+ACCEPT_FORMATS = {
+    'image/webp': 'webp',
+    'image/jpeg': 'jpeg',
+    'image/png': 'png'
+}
+
+
+class EncodingOptions:
+    """
+    How an image response is encoded.
+
+    - format: 'png', 'webp', 'jpeg', or 'mask' (1-bit PNG of the mask only)
+    - quality: WebP/JPEG quality (1-100)
+    - compress_level: PNG zlib level (0-9); lower is faster and larger
+    - max_side: downscale so the longer side is at most this many pixels (preview)
+    """
+
+    def __init__(self, format: str = 'png', quality: int = 90, compress_level: int = 1,
+                 max_side: int | None = None):
+        if format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format: {format}")
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.max_side = max_side
+
+
+def encoding_options(request: Request, format: str | None = None, quality: int = 90,
+                     compress_level: int = 1, max_side: int | None = None) -> EncodingOptions:
+    """
+    FastAPI dependency negotiating the response encoding.
+
+    An explicit ?format= wins; otherwise the first supported type in the Accept
+    header is used, falling back to PNG.
+    """
+    if format is None:
+        format = 'png'
+        accepted = [part.split(';')[0].strip()
+                    for part in request.headers.get('accept', '').split(',')]
+        for media_type in accepted:
+            if media_type in ACCEPT_FORMATS:
+                format = ACCEPT_FORMATS[media_type]
+                break
+    if not 1 <= quality <= 100 or not 0 <= compress_level <= 9:
+        raise HTTPException(
+            status_code=400, detail="quality must be 1-100 and compress_level 0-9.")
+    try:
+        return EncodingOptions(format, quality, compress_level, max_side)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def encode_image(image: Image.Image, options: EncodingOptions) -> tuple[bytes, dict]:
+    """
+    Encode an image and report how long it took.
+
+    Returns:
+    - tuple[bytes, dict]: The encoded bytes and {"format", "encode_ms", "bytes", "size"}.
+    """
+    start = time.perf_counter()
+    if options.max_side and max(image.size) > options.max_side:
+        ratio = options.max_side / max(image.size)
+        image = image.resize((max(1, int(image.width * ratio)),
+                              max(1, int(image.height * ratio))), Image.BILINEAR)
+
+    buffer = BytesIO()
+    if options.format == 'mask':
+        image.convert('1').save(
+            buffer, format='PNG', compress_level=options.compress_level)
+    elif options.format == 'png':
+        image.save(buffer, format='PNG',
+                   compress_level=options.compress_level)
+    elif options.format == 'webp':
+        image.save(buffer, format='WEBP', quality=options.quality, method=0)
+    else:
+        image.convert('RGB').save(
+            buffer, format='JPEG', quality=options.quality)
+    content = buffer.getvalue()
+
+    stats = {
+        "format": options.format,
+        "encode_ms": (time.perf_counter() - start) * 1000,
+        "bytes": len(content),
+        "size": list(image.size)
+    }
+    STAGE_SECONDS.labels(stage=f"encode_{options.format}").observe(
+        stats["encode_ms"] / 1000)
+    logger.info(f"Encoded {stats['size']} as {stats['format']} "
+                f"({stats['bytes']} bytes) in {stats['encode_ms']:.1f} ms")
+    return content, stats
+
+
+def image_response(image: Image.Image, options: EncodingOptions) -> Response:
+    """Encode an image into a Response carrying the encode time and size as headers."""
+    content, stats = encode_image(image, options)
+    return Response(content=content, media_type=IMAGE_FORMATS[options.format], headers={
+        "X-Encode-Time-Ms": f"{stats['encode_ms']:.2f}",
+        "X-Encoded-Bytes": str(stats['bytes'])
+    })
+
+
+def mask_image(masks: np.ndarray) -> Image.Image:
+    """Union of (N, 1, H, W) or (N, H, W) masks as a binary L image for 1-bit encoding."""
+    masks = np.asarray(masks)
+    union = (masks.reshape(-1, *masks.shape[-2:]) > 0.5).any(axis=0)
+    return Image.fromarray(union.astype(np.uint8) * 255)
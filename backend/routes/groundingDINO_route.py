@@ -1,10 +1,13 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse, Response
 from fastapi import File, Form, UploadFile
 from pydantic import BaseModel
 from io import BytesIO
 from PIL import Image
-from model.groundingDINO import groundingdino_model
+from model.groundingDINO import get_groundingdino_model, GroundingDINOState, BOX_TRESHOLD, TEXT_TRESHOLD
+from model.image_store import image_store
+from model.session import Session
+from routes.session import get_session, loaded_model_stats, use_image
 import numpy as np
 import logging
 
@@ -20,21 +23,71 @@ async def root():
 class GroundingDINORequest(BaseModel):
     prompt: str
     single_target_mode: bool
+    image_id: str | None = None
+    box_threshold: float = BOX_TRESHOLD
+    text_threshold: float = TEXT_TRESHOLD
+
+
+class GroundingDINOBatchRequest(BaseModel):
+    prompts: list[str]
+    single_target_mode: bool
+    image_id: str | None = None
+    box_threshold: float = BOX_TRESHOLD
+    text_threshold: float = TEXT_TRESHOLD
+
+
+def groundingdino_state(session: Session) -> GroundingDINOState:
+    return session.state("groundingdino", GroundingDINOState)
 
 
 @router.post("/predict")
-async def predict(request: GroundingDINORequest):
-    groundingdino_model.predict(request.prompt, request.single_target_mode)
+def predict(request: GroundingDINORequest, session: Session = Depends(get_session)):
+    groundingdino_model = get_groundingdino_model()
+    with session.lock:
+        state = groundingdino_state(session)
+        use_image(groundingdino_model, state, request.image_id)
+        try:
+            groundingdino_model.predict(state, request.prompt, request.single_target_mode,
+                                        request.box_threshold, request.text_threshold)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return JSONResponse(content={
+            "boxes": groundingdino_model.get_boxes(state),
+            "logits": groundingdino_model.get_logits(state),
+            "phrases": groundingdino_model.get_phrases(state)
+        })
+
+
+@router.post("/predict_batch")
+def predict_batch(request: GroundingDINOBatchRequest, session: Session = Depends(get_session)):
+    """Detect several prompts against the same image, sharing its backbone features."""
+    groundingdino_model = get_groundingdino_model()
+    with session.lock:
+        state = groundingdino_state(session)
+        use_image(groundingdino_model, state, request.image_id)
+        try:
+            results = groundingdino_model.predict_batch(
+                state, request.prompts, request.single_target_mode,
+                request.box_threshold, request.text_threshold)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"results": results})
 
-    print("boxes: ", groundingdino_model.get_boxes())
-    print("logits: ", groundingdino_model.get_logits())
-    print("phrases: ", groundingdino_model.get_phrases())
 
-    return JSONResponse(content={"boxes": groundingdino_model.get_boxes(), "logits": groundingdino_model.get_logits(), "phrases": groundingdino_model.get_phrases()})
+@router.get("/cache_stats")
+async def cache_stats():
+    def stats():
+        groundingdino_model = get_groundingdino_model()
+        return {
+            "features": groundingdino_model.feature_cache.stats(),
+            "results": groundingdino_model.result_cache.stats()
+        }
+    return loaded_model_stats("groundingdino", stats)
 
 
 @router.post("/set_image")
-async def set_image(image: UploadFile = File(...)):
+def set_image(image: UploadFile = File(...), session: Session = Depends(get_session)):
     """
     Endpoint to add an image to the SAM2 model.
 
@@ -44,6 +97,7 @@ async def set_image(image: UploadFile = File(...)):
     Returns:
     - JSONResponse: A success message or an error message.
     """
+    groundingdino_model = get_groundingdino_model()
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
     try:
         # validate the image
@@ -53,12 +107,15 @@ async def set_image(image: UploadFile = File(...)):
                 status_code=400, detail="Invalid image format.")
 
         # read the image
-        image_bytes = await image.read()
-        await image.close()
+        image_bytes = image.file.read()
+        image.file.close()
 
-        groundingdino_model.set_image(image_bytes)
+        image_id, _ = image_store.put(image_bytes)
+        with session.lock:
+            groundingdino_model.set_image(
+                groundingdino_state(session), image_id)
         logger.info("Image set successfully.")
-        return JSONResponse(content={"message": "Image set successfully"}, status_code=200)
+        return JSONResponse(content={"message": "Image set successfully", "image_id": image_id}, status_code=200)
     except Exception as e:
         logger.error(f"Error setting image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,67 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
+from fastapi import File, UploadFile
+from model.image_store import image_store
+import logging
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+
+
+@router.get("/")
+async def root():
+    return {"message": "This is the Image route"}
+
+
+@router.post("/upload")
+def upload(image: UploadFile = File(...)):
+    """
+    Endpoint to upload an image once for every model.
+
+    Parameters:
+    - image (UploadFile): The image file uploaded by the user.
+
+    Returns:
+    - JSONResponse: The image id that SAM2, GroundingDINO and diffusion requests refer to.
+    """
+    try:
+        # Validate the uploaded file
+        file_extension = image.filename.split('.')[-1].lower()
+        if file_extension not in ALLOWED_EXTENSIONS:
+            raise HTTPException(
+                status_code=400, detail="Invalid image format.")
+
+        # Read the image bytes
+        image_bytes = image.file.read()
+        image.file.close()
+
+        image_id, is_new = image_store.put(image_bytes)
+        width, height = image_store.get(image_id).size
+
+        logger.info(f"Image {image_id} stored (new: {is_new}).")
+        return JSONResponse(content={
+            "image_id": image_id,
+            "width": width,
+            "height": height,
+            "is_new": is_new
+        }, status_code=200)
+    except HTTPException as http_err:
+        logger.error(f"HTTP error: {http_err.detail}")
+        raise http_err
+    except ValueError as e:
+        logger.error(f"Error uploading image: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error uploading image: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/{image_id}")
+async def get_image_info(image_id: str):
+    try:
+        width, height = image_store.get(image_id).size
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"image_id": image_id, "width": width, "height": height}
@@ -1,10 +1,14 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse, Response
 from fastapi import File, Form, UploadFile
 from pydantic import BaseModel
-from io import BytesIO
 from PIL import Image
-from model.sam2 import sam2_model
+from model.sam2 import get_sam2_model, SAM2State
+from model.image_store import image_store
+from model.mask_store import mask_store, encode_mask, MASK_ENCODINGS
+from routes.encoding import EncodingOptions, encoding_options, image_response, mask_image
+from routes.session import get_session, loaded_model_stats, use_image
+from model.session import Session
 import numpy as np
 import logging
 
@@ -17,79 +21,87 @@ async def root():
     return {"message": "Hello World"}
 
 
-class SegmentWithTextRequest(BaseModel):
-    boxes: list[list[float]]  # List of [x, y, width, height] coordinates
-
-
-@router.post("/segment_with_text")
-async def segment_with_text(request: SegmentWithTextRequest):
-    try:
-        # Convert boxes to numpy array
-        boxes = np.array(request.boxes)
+def sam2_state(session: Session) -> SAM2State:
+    return session.state("sam2", SAM2State)
 
-        # Segment image using SAM2 model with boxes
-        sam2_model.segment_from_boxes(boxes)
 
-        # Apply blue mask to image
-        applied_mask = sam2_model.apply_bluer_mask()
-
-        # Convert numpy array to PIL Image
-        pil_image = Image.fromarray(applied_mask.astype('uint8'), 'RGB')
+def overlay_response(sam2_model, state: SAM2State, options: EncodingOptions,
+                     layer_only: bool = False) -> Response:
+    """
+    The image with the blue mask overlay, encoded as negotiated. With layer_only just
+    the RGBA overlay layer is returned, and format=mask returns a 1-bit mask PNG, for
+    the client to composite over its own copy.
+    """
+    if options.format == 'mask':
+        pil_image = mask_image(sam2_model.get_masks(state))
+    elif layer_only:
+        pil_image = Image.fromarray(sam2_model.get_mask_layer(state), 'RGBA')
+    else:
+        pil_image = Image.fromarray(sam2_model.apply_bluer_mask(state), 'RGB')
+    return image_response(pil_image, options)
 
-        # Create a byte stream to hold the image data
-        img_byte_arr = BytesIO()
 
-        # Save the image as PNG to the byte stream
-        pil_image.save(img_byte_arr, format='PNG')
+class SegmentWithTextRequest(BaseModel):
+    boxes: list[list[float]]  # List of [x, y, width, height] coordinates
+    image_id: str | None = None
 
-        # Get the byte string from the stream
-        img_byte_arr = img_byte_arr.getvalue()
 
-        # Return the image as a binary response
-        return Response(content=img_byte_arr, media_type="image/png")
-    except Exception as e:
-        logger.error(f"Error in segment_with_text: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+@router.post("/segment_with_text")
+def segment_with_text(request: SegmentWithTextRequest, layer_only: bool = False,
+                      options: EncodingOptions = Depends(encoding_options),
+                      session: Session = Depends(get_session)):
+    sam2_model = get_sam2_model()
+    with session.lock:
+        state = sam2_state(session)
+        use_image(sam2_model, state, request.image_id)
+        try:
+            # Convert boxes to numpy array
+            boxes = np.array(request.boxes)
+
+            # Segment image using SAM2 model with boxes
+            sam2_model.segment_from_boxes(state, boxes)
+
+            # Apply blue mask to image
+            return overlay_response(sam2_model, state, options, layer_only)
+        except Exception as e:
+            logger.error(f"Error in segment_with_text: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
 
 
 class SegmentRequest(BaseModel):
     normalized_x: float
     normalized_y: float
+    image_id: str | None = None
 
 
 @router.post("/segment")
-async def segment_image(
-    request: SegmentRequest
+def segment_image(
+    request: SegmentRequest,
+    layer_only: bool = False,
+    options: EncodingOptions = Depends(encoding_options),
+    session: Session = Depends(get_session)
 ):
+    sam2_model = get_sam2_model()
+    with session.lock:
+        state = sam2_state(session)
+        use_image(sam2_model, state, request.image_id)
 
-    # segment image using SAM2 model
-    sam2_model.segment(
-        np.array([[request.normalized_x, request.normalized_y]]), np.array([1]))
-    print("segmented image shape: ", np.array(sam2_model.image).shape)
-    print("segmented masks shape: ", np.array(sam2_model.masks).shape)
-    # apply blue mask to image
-    applied_mask = sam2_model.apply_bluer_mask()
-
-    # Convert numpy array to PIL Image
-    pil_image = Image.fromarray(applied_mask.astype('uint8'), 'RGB')
+        # segment image using SAM2 model
+        try:
+            sam2_model.segment(
+                state, np.array([[request.normalized_x, request.normalized_y]]), np.array([1]))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-    # Create a byte stream to hold the image data
-    img_byte_arr = BytesIO()
+        # apply blue mask to image
+        return overlay_response(sam2_model, state, options, layer_only)
 
-    # Save the image as PNG to the byte stream
-    pil_image.save(img_byte_arr, format='PNG')
-
-    # Get the byte string from the stream
-    img_byte_arr = img_byte_arr.getvalue()
-
-    # Return the image as a binary response
-    return Response(content=img_byte_arr, media_type="image/png")
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 
 @router.post("/add-image")
-async def add_image(image: UploadFile = File(...)):
+def add_image(image: UploadFile = File(...), session: Session = Depends(get_session)):
     """
     Endpoint to add an image to the SAM2 model.
 
@@ -99,6 +111,7 @@ async def add_image(image: UploadFile = File(...)):
     Returns:
     - JSONResponse: A success message or an error message.
     """
+    sam2_model = get_sam2_model()
     try:
         # Validate the uploaded file
         file_extension = image.filename.split('.')[-1].lower()
@@ -107,14 +120,16 @@ async def add_image(image: UploadFile = File(...)):
                 status_code=400, detail="Invalid image format.")
 
         # Read the image bytes
-        image_bytes = await image.read()
-        await image.close()  # Close the file after reading
+        image_bytes = image.file.read()
+        image.file.close()  # Close the file after reading
 
-        # Set the image in the SAM2 model
-        sam2_model.set_image(image_bytes)
+        # Store the image once and set it in the SAM2 model
+        image_id, _ = image_store.put(image_bytes)
+        with session.lock:
+            sam2_model.set_image(sam2_state(session), image_id)
 
         logger.info("Image added successfully.")
-        return JSONResponse(content={"message": "Image added successfully"}, status_code=200)
+        return JSONResponse(content={"message": "Image added successfully", "image_id": image_id}, status_code=200)
     except HTTPException as http_err:
         logger.error(f"HTTP error: {http_err.detail}")
         raise http_err
@@ -123,9 +138,35 @@ async def add_image(image: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/cache_stats")
+async def cache_stats():
+    return loaded_model_stats("sam2", lambda: get_sam2_model().embedding_cache.stats())
+
+
 @router.get("/get_masks")
-async def get_masks():
-    masks = sam2_model.get_masks()
-    print("masks shape: ", masks.shape)
-    print("masks original: ", masks)
-    return masks.tolist()
+def get_masks(format: str = "id", session: Session = Depends(get_session)):
+    """
+    Return the current masks.
+
+    Parameters:
+    - format (str): 'id' returns only a mask id that inpainting requests can
+        reference, 'bitpacked' or 'rle' also include the compactly encoded mask,
+        and 'list' returns the legacy nested float list.
+    """
+    sam2_model = get_sam2_model()
+    with session.lock:
+        try:
+            masks = sam2_model.get_masks(sam2_state(session))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if format == "list":
+        return masks.tolist()
+    if format != "id" and format not in MASK_ENCODINGS:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown mask format: {format}")
+
+    mask_id = mask_store.put(masks)
+    content = {"mask_id": mask_id, "shape": list(masks.shape)}
+    if format in MASK_ENCODINGS:
+        content["mask"] = encode_mask(masks, format)
+    return JSONResponse(content=content)
@@ -0,0 +1,36 @@
+from collections.abc import Callable, Iterator
+from fastapi import Header, HTTPException
+from model.registry import registry
+from model.session import Session, session_manager
+
+
+def get_session(x_session_id: str | None = Header(default=None)) -> Iterator[Session]:
+    """
+    FastAPI dependency yielding the caller's session from the X-Session-Id header.
+
+    Clients that send no header share the "default" session. The session cannot be
+    evicted until the request is done with it.
+    """
+    session = session_manager.acquire(x_session_id or "default")
+    try:
+        yield session
+    finally:
+        session_manager.release(session)
+
+
+def use_image(model, state, image_id: str | None):
+    """Switch a model's session state to a stored image if the request names one."""
+    if image_id is None:
+        return
+    try:
+        model.set_image(state, image_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def loaded_model_stats(name: str, stats: Callable[[], dict]) -> dict:
+    """stats() of a registered model, or {} if it is not loaded yet."""
+    # Reporting stats must not load the model on workers that never used it
+    if not registry.is_loaded(name):
+        return {}
+    return stats()
@@ -0,0 +1,87 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from PIL import Image
+from model.sam2 import get_sam2_model
+from model.groundingDINO import get_groundingdino_model, BOX_TRESHOLD, TEXT_TRESHOLD
+from model.mask_store import mask_store
+from routes.encoding import EncodingOptions, encoding_options, encode_image, mask_image
+from routes.session import get_session, use_image
+from routes.sam2_route import sam2_state
+from routes.groundingDINO_route import groundingdino_state
+from model.session import Session
+import base64
+import logging
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+
+@router.get("/")
+async def root():
+    return {"message": "This is the Text2Mask route"}
+
+
+class Text2MaskRequest(BaseModel):
+    image_id: str
+    prompt: str
+    single_target_mode: bool = True
+    box_threshold: float = BOX_TRESHOLD
+    text_threshold: float = TEXT_TRESHOLD
+    layer_only: bool = False
+
+
+@router.post("/segment")
+def segment(request: Text2MaskRequest, options: EncodingOptions = Depends(encoding_options),
+            session: Session = Depends(get_session)):
+    """
+    Detect a prompt with GroundingDINO and segment the detections with SAM2 in one call.
+
+    The detector's box tensor goes straight into a single batched SAM2 prediction.
+
+    Returns:
+    - JSONResponse: mask_id (usable in inpainting requests), pixel xyxy boxes,
+        logits, phrases and the base64 overlay encoded as negotiated.
+    """
+    groundingdino_model = get_groundingdino_model()
+    sam2_model = get_sam2_model()
+    with session.lock:
+        detection_state = groundingdino_state(session)
+        segmentation_state = sam2_state(session)
+        use_image(groundingdino_model, detection_state, request.image_id)
+        use_image(sam2_model, segmentation_state, request.image_id)
+
+        try:
+            groundingdino_model.predict(
+                detection_state, request.prompt, request.single_target_mode,
+                request.box_threshold, request.text_threshold)
+            boxes = detection_state.boxes
+            if len(boxes) == 0:
+                return JSONResponse(content={"mask_id": None, "boxes": [], "logits": [],
+                                             "phrases": [], "overlay": None})
+
+            xyxy = sam2_model.segment_from_boxes(segmentation_state, boxes)
+            masks = sam2_model.get_masks(segmentation_state)
+            mask_id = mask_store.put(masks)
+
+            if options.format == 'mask':
+                overlay = mask_image(masks)
+            elif request.layer_only:
+                overlay = Image.fromarray(
+                    sam2_model.get_mask_layer(segmentation_state), 'RGBA')
+            else:
+                overlay = Image.fromarray(
+                    sam2_model.apply_bluer_mask(segmentation_state), 'RGB')
+            content, stats = encode_image(overlay, options)
+        except Exception as e:
+            logger.error(f"Error in text2mask: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+        return JSONResponse(content={
+            "mask_id": mask_id,
+            "boxes": xyxy.tolist(),
+            "logits": detection_state.logits.tolist(),
+            "phrases": detection_state.phrases,
+            "overlay": base64.b64encode(content).decode('ascii'),
+            "overlay_encoding": stats
+        })
@@ -1,11 +1,15 @@
 import axios from 'axios';
 import config from '../config';
 
+// One server-side session (current image, embeddings, masks) per browser tab
+const sessionId = crypto.randomUUID();
+
 const axiosInstance = axios.create({
   baseURL: config.apiBaseUrl,
   headers: {
     "ngrok-skip-browser-warning": "69420",
-    "Access-Control-Allow-Origin": config.apiBaseUrl
+    "Access-Control-Allow-Origin": config.apiBaseUrl,
+    "X-Session-Id": sessionId
   }
 });
 
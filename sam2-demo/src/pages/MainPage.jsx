@@ -4,6 +4,7 @@ import axiosInstance from '../axiosInstance'
 export default function Component() {
   const [imageSegment, setImageSegment] = useState(null)
   const [imageInpainting, setImageInpainting] = useState(null)
+  const [imageId, setImageId] = useState(null)
   const [coordinates, setCoordinates] = useState(null)
   const [apiResponse, setApiResponse] = useState(null)
   const [singleTargetMode, setSingleTargetMode] = useState(true)
@@ -45,7 +46,8 @@ export default function Component() {
         // Update the field names to match the backend SegmentRequest model
         const response = await axiosInstance.post('/sam2/segment', {
           normalized_x: normalizedX,
-          normalized_y: normalizedY
+          normalized_y: normalizedY,
+          image_id: imageId
         }, { responseType: 'blob' })
         
         // Create a URL from the Blob
@@ -76,29 +78,22 @@ export default function Component() {
     }
     else {
       try {
-        // First get the boxes from GroundingDINO
-        const dinoResponse = await axiosInstance.post('/groundingdino/predict', { 
+        // Detect and segment the prompt in one round trip
+        const segmentResponse = await axiosInstance.post('/text2mask/segment', {
+          image_id: imageId,
           prompt: segmentPrompt.current.value,
           single_target_mode: singleTargetMode
         })
-        
-        // Then use the boxes for SAM2 segmentation
-        const response = await axiosInstance.post('/sam2/segment_with_text', {
-          boxes: dinoResponse.data.boxes,
-        }, { responseType: 'blob' })
+        if (!segmentResponse.data.mask_id) {
+          setApiResponse('Nothing found for this prompt')
+          return
+        }
+        setImageSegment(`data:image/png;base64,${segmentResponse.data.overlay}`)
 
-        // Create a URL from the Blob
-        const imageSegmentUrl = URL.createObjectURL(response.data)
-        setImageSegment(imageSegmentUrl)
-
-        // Get masks from SAM2 (shape must be (1, H, W))
-        const masksResponse = await axiosInstance.get('/sam2/get_masks')
-        console.log(masksResponse.data)
-        
         // Inpainting
         const inpaintingResponse = await axiosInstance.post('/diffusion/inpainting', {
           prompt: inpaintingPrompt.current.value,
-          mask: masksResponse.data,
+          mask_id: segmentResponse.data.mask_id,
           postprocess_mode: postprocessMode,
           is_applying_blur: isApplyingBlur,
           using_canny_control_image: usingCannyControl,
@@ -106,7 +101,8 @@ export default function Component() {
           guidance_scale: guidanceScale,
           controlnet_conditioning_scale: controlnetScale,
           num_samples: numSamples,
-          mask_rescale: maskRescaleFactor
+          mask_rescale: maskRescaleFactor,
+          image_id: imageId
         }, { responseType: 'blob' })
 
         // Create a URL from the Blob
@@ -131,13 +127,10 @@ export default function Component() {
       const formData = new FormData()
       formData.append('image', file)
       try {
-        const response_dino = await axiosInstance.post('/groundingdino/set_image', formData)
-        console.log(response_dino.data.message)
-        const response_sam = await axiosInstance.post('/sam2/add-image', formData)
-        console.log(response_sam.data.message)
-        const response_diffusion = await axiosInstance.post('/diffusion/set_image', formData)
-        console.log(response_diffusion.data.message)
-        setApiResponse(response_sam.data.message)
+        // Upload once; every model refers to the image by its id
+        const response = await axiosInstance.post('/images/upload', formData)
+        setImageId(response.data.image_id)
+        setApiResponse(`Image uploaded (${response.data.width}x${response.data.height})`)
       } catch (error) {
         console.error('Error uploading image:', error)
         setApiResponse('Error uploading image')